@@ -1,16 +1,24 @@
 import os
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Set, Callable, Awaitable
 import uuid
+import asyncio
 import time
+import base64
+import hashlib
 from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from pydantic import BaseModel, Field
 import httpx
-from supabase import create_client, Client
-import redis
+from supabase import acreate_client, AsyncClient
+import redis.asyncio as aioredis
 from redis.exceptions import ConnectionError
-import json
+from collections import defaultdict
+import numpy as np
+from cachetools import TTLCache
+import tiktoken
 from tenacity import retry, stop_after_attempt, wait_exponential
+from openai import AsyncOpenAI
 
 # LlamaIndex imports
 from llama_index.embeddings.openai import OpenAIEmbedding
@@ -18,7 +26,7 @@ from llama_index.embeddings.base import BaseEmbedding
 from llama_index.core.schema import TextNode, NodeWithEmbedding
 
 # FastAPI app
-app = FastAPI(title="Linktree AI - Embeddings Service")
+app = FastAPI(title="Linktree AI - Embeddings Service", default_response_class=ORJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -37,17 +45,80 @@ REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379")
 DEFAULT_EMBEDDING_MODEL = os.environ.get("DEFAULT_EMBEDDING_MODEL", "text-embedding-3-small")
 DEFAULT_EMBEDDING_DIMENSION = int(os.environ.get("DEFAULT_EMBEDDING_DIMENSION", "1536"))
 EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "100"))
+MICRO_BATCH_WINDOW_MS = int(os.environ.get("MICRO_BATCH_WINDOW_MS", "20"))
+MAX_IN_FLIGHT_BATCHES = int(os.environ.get("MAX_IN_FLIGHT_BATCHES", "4"))
+OPENAI_MAX_CONCURRENT_REQUESTS = int(os.environ.get("OPENAI_MAX_CONCURRENT_REQUESTS", "4"))
+TOKEN_USAGE_FLUSH_INTERVAL = float(os.environ.get("TOKEN_USAGE_FLUSH_INTERVAL", "1.0"))
+EMBEDDING_LOCAL_CACHE_SIZE = int(os.environ.get("EMBEDDING_LOCAL_CACHE_SIZE", "10000"))
+EMBEDDING_LOCAL_CACHE_TTL = int(os.environ.get("EMBEDDING_LOCAL_CACHE_TTL", "300"))
+TENANT_CACHE_TTL = int(os.environ.get("TENANT_CACHE_TTL", "60"))
+CACHE_KEY_THREAD_THRESHOLD = int(os.environ.get("CACHE_KEY_THREAD_THRESHOLD", "512"))
+EMBEDDING_CACHE_DTYPE = os.environ.get("EMBEDDING_CACHE_DTYPE", "float32")
+
+if EMBEDDING_CACHE_DTYPE not in ("float32", "float16", "int8"):
+    raise ValueError(f"Unsupported EMBEDDING_CACHE_DTYPE: {EMBEDDING_CACHE_DTYPE}")
+
+# Embedding returned for empty texts, immutable so it can be shared safely
+ZERO_EMBEDDING = (0.0,) * DEFAULT_EMBEDDING_DIMENSION
+
+# Bumped whenever the cached value format changes
+EMBEDDING_CACHE_PREFIX = "linktree-embed-v2"
+
+# OpenAI embeddings API request limits
+OPENAI_MAX_INPUTS_PER_REQUEST = 2048
+OPENAI_MAX_TOKENS_PER_REQUEST = 250_000
 
 # Redis connection for caching
 try:
-    redis_client = redis.from_url(REDIS_URL)
+    redis_client = aioredis.from_url(REDIS_URL)
     print("Redis connected successfully")
 except ConnectionError:
     print("Warning: Redis connection failed. Running without cache.")
     redis_client = None
 
-# Supabase client
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# INCR the window counter and start its TTL on the first hit
+RATE_LIMIT_SCRIPT = """
+local current = redis.call('INCR', KEYS[1])
+if current == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return current
+"""
+RATE_LIMIT_PER_MINUTE = 600
+RATE_LIMIT_WINDOW_SECONDS = 60
+
+rate_limit_script = redis_client.register_script(RATE_LIMIT_SCRIPT) if redis_client else None
+
+# In-process cache of verified tenants
+tenant_cache: TTLCache = TTLCache(maxsize=10_000, ttl=TENANT_CACHE_TTL)
+
+# Shared keep-alive HTTP/2 client for OpenAI, so cache misses reuse open connections
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=30.0,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+)
+
+# Supabase client, created on startup since the async client is built in a coroutine
+supabase: Optional[AsyncClient] = None
+
+# Cached embeddings are stored as raw bytes: float32, float16, or int8 with a
+# float32 per-vector scale header. float16 and int8 are lossy opt-ins: a cache hit then
+# returns a rounded vector rather than the one OpenAI produced
+def _serialize_embedding(embedding: List[float], dtype: str = "float32") -> bytes:
+    vector = np.asarray(embedding, dtype=np.float32)
+    if dtype == "int8":
+        scale = float(np.max(np.abs(vector))) or 1.0
+        quantized = np.round(vector / scale * 127).astype(np.int8)
+        return np.float32(scale).tobytes() + quantized.tobytes()
+    return vector.astype(dtype).tobytes()
+
+def _deserialize_embedding(raw: bytes, dtype: str = "float32") -> List[float]:
+    if dtype == "int8":
+        scale = np.frombuffer(raw, dtype=np.float32, count=1)[0]
+        quantized = np.frombuffer(raw, dtype=np.int8, offset=4)
+        return (quantized.astype(np.float32) * (scale / 127)).tolist()
+    return np.frombuffer(raw, dtype=dtype).tolist()
 
 # OpenAI Embedding model with caching
 class CachedOpenAIEmbedding(BaseEmbedding):
@@ -58,6 +129,10 @@ class CachedOpenAIEmbedding(BaseEmbedding):
         api_key: Optional[str] = None,
         cache_prefix: str = "embed",
         cache_ttl: int = 86400 * 7,  # 7 days default
+        cache_dtype: str = EMBEDDING_CACHE_DTYPE,
+        http_client: Optional[httpx.AsyncClient] = None,
+        local_cache_size: int = EMBEDDING_LOCAL_CACHE_SIZE,
+        local_cache_ttl: int = EMBEDDING_LOCAL_CACHE_TTL,
     ):
         super().__init__(model_name=model_name)
         self.api_key = api_key or OPENAI_API_KEY
@@ -67,119 +142,343 @@ class CachedOpenAIEmbedding(BaseEmbedding):
             api_key=self.api_key,
             embed_batch_size=embed_batch_size
         )
+        self.async_client = AsyncOpenAI(api_key=self.api_key, http_client=http_client)
+        self._openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENT_REQUESTS)
         self.cache_prefix = cache_prefix
         self.cache_ttl = cache_ttl
+        self.cache_dtype = cache_dtype
+        # Model and storage dtype are part of the key so entries never get misread
+        self._cache_key_suffix = f"{model_name}:{cache_dtype}:"
+        # In-process copy of hot Redis values (serialized bytes, not float lists, to
+        # keep it small). Values under a key never change, the TTL only bounds how
+        # long a clear on another worker takes to be seen here
+        self._local_cache: TTLCache = TTLCache(maxsize=local_cache_size, ttl=local_cache_ttl)
+    
+    def _get_cache_key_prefix(self, tenant_id: Optional[str] = None) -> str:
+        # Tenant goes first so one tenant's entries can be scanned and cleared on their own
+        return f"{self.cache_prefix}:{tenant_id or 'shared'}:{self._cache_key_suffix}"
     
-    def _get_cache_key(self, text: str) -> str:
+    def _get_cache_key(self, text: str, tenant_id: Optional[str] = None) -> str:
         """Generate a cache key for a text."""
-        import hashlib
-        # Create hash from text and model name to ensure uniqueness
-        text_hash = hashlib.md5(text.encode()).hexdigest()
-        return f"{self.cache_prefix}:{self.model_name}:{text_hash}"
+        # Short binary digest, base64-encoded to keep keys compact
+        digest = hashlib.blake2b(text.encode(), digest_size=16).digest()
+        return self._get_cache_key_prefix(tenant_id) + base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+    
+    def _get_cache_keys(self, texts: List[str], tenant_id: Optional[str] = None) -> List[str]:
+        """Generate cache keys for many texts with the per-call lookups hoisted."""
+        prefix = self._get_cache_key_prefix(tenant_id)
+        blake2b = hashlib.blake2b
+        b64encode = base64.urlsafe_b64encode
+        return [
+            prefix + b64encode(blake2b(text.encode(), digest_size=16).digest()).rstrip(b"=").decode()
+            for text in texts
+        ]
+    
+    async def _aget_cache_keys(self, texts: List[str], tenant_id: Optional[str] = None) -> List[str]:
+        # hashlib releases the GIL on large inputs, so big batches hash in a
+        # worker thread instead of stalling the event loop
+        if len(texts) >= CACHE_KEY_THREAD_THRESHOLD:
+            return await asyncio.to_thread(self._get_cache_keys, texts, tenant_id)
+        return self._get_cache_keys(texts, tenant_id)
     
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
     def _get_text_embedding(self, text: str) -> List[float]:
-        """Get embedding with caching."""
+        """Sync LlamaIndex hook, uncached; the service uses the async path."""
         if not text.strip():
             # Return zero vector for empty text
-            return [0.0] * DEFAULT_EMBEDDING_DIMENSION
-            
-        # Try to get from cache first
-        if redis_client:
-            cache_key = self._get_cache_key(text)
-            cached_embedding = redis_client.get(cache_key)
-            
-            if cached_embedding:
-                return json.loads(cached_embedding)
-        
-        # Get from OpenAI if not in cache
-        embedding = self.openai_embed._get_text_embedding(text)
-        
-        # Store in cache if available
-        if redis_client:
-            cache_key = self._get_cache_key(text)
-            redis_client.setex(
-                cache_key,
-                self.cache_ttl,
-                json.dumps(embedding)
-            )
+            return list(ZERO_EMBEDDING)
         
-        return embedding
+        return self.openai_embed._get_text_embedding(text)
     
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
     def _get_text_embedding_batch(self, texts: List[str]) -> List[List[float]]:
+        """Sync LlamaIndex hook, uncached; the service uses the async path."""
+        indices = [i for i, text in enumerate(texts) if text.strip()]
+        embeddings = self.openai_embed._get_text_embedding_batch([texts[i] for i in indices]) if indices else []
+        
+        result = [list(ZERO_EMBEDDING) for _ in texts]
+        for i, embedding in zip(indices, embeddings):
+            result[i] = embedding
+        return result
+    
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        """Get embedding with caching."""
+        embeddings, _ = await self.aget_text_embedding_batch_with_stats([text])
+        return embeddings[0]
+    
+    async def _aget_text_embedding_batch(self, texts: List[str]) -> List[List[float]]:
         """Get embeddings for a batch of texts with caching."""
+        embeddings, _ = await self.aget_text_embedding_batch_with_stats(texts)
+        return embeddings
+    
+    async def _aembed_with_openai(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts with the async OpenAI client, bypassing the cache."""
+        # Split into requests OpenAI accepts and send them concurrently
+        chunks = self._split_for_openai(texts)
+        results = await asyncio.gather(*(self._aembed_chunk(chunk) for chunk in chunks))
+        
+        # Chunks are contiguous, so concatenating keeps the original order
+        return [embedding for chunk_embeddings in results for embedding in chunk_embeddings]
+    
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
+    async def _aembed_chunk(self, texts: List[str]) -> List[List[float]]:
+        async with self._openai_semaphore:
+            response = await self.async_client.embeddings.create(model=self.model_name, input=texts)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+    
+    @staticmethod
+    def _split_for_openai(texts: List[str]) -> List[List[str]]:
+        """Split texts into chunks within OpenAI's per-request input and token limits."""
+        chunks = []
+        current = []
+        current_tokens = 0
+        
+        for text in texts:
+            # Cheap estimate, the token budget leaves headroom below the real cap
+            tokens = len(text) // 4 + 1
+            if current and (
+                len(current) >= OPENAI_MAX_INPUTS_PER_REQUEST
+                or current_tokens + tokens > OPENAI_MAX_TOKENS_PER_REQUEST
+            ):
+                chunks.append(current)
+                current = []
+                current_tokens = 0
+            current.append(text)
+            current_tokens += tokens
+        
+        if current:
+            chunks.append(current)
+        return chunks
+    
+    async def aget_text_embedding_batch_with_stats(
+        self,
+        texts: List[str],
+        tenant_id: Optional[str] = None
+    ) -> Tuple[List[List[float]], int]:
+        """Async variant that sends cache misses through the shared micro-batcher."""
         if not texts:
-            return []
-            
-        # Check which texts are in cache
-        cache_hits = {}
+            return [], 0
+        
+        result, texts_to_embed, keys_to_embed, original_indices, cached_count = await self._lookup_cached(texts, tenant_id)
+        
+        # If all texts were in cache, the result is already complete
+        if not texts_to_embed:
+            return result, cached_count
+        
+        # Misses from concurrent requests are coalesced into shared OpenAI calls
+        embeddings = await embedding_batcher.embed(texts_to_embed)
+        await self._store_cached(keys_to_embed, embeddings)
+        
+        # Add new embeddings at every position their text appeared
+        for indices, embedding in zip(original_indices, embeddings):
+            for idx in indices:
+                result[idx] = embedding
+        
+        return result, cached_count
+    
+    async def _lookup_cached(
+        self,
+        texts: List[str],
+        tenant_id: Optional[str] = None
+    ) -> Tuple[List[Optional[List[float]]], List[str], List[str], List[List[int]], int]:
+        """Fill in cached embeddings and return the unique texts (with their keys) that still need embedding."""
+        result: List[Optional[List[float]]] = [None] * len(texts)
         texts_to_embed = []
+        keys_to_embed = []
         original_indices = []
+        cached_count = 0
+        
+        # Empty texts share the immutable zero vector and never touch the cache;
+        # duplicates are looked up and embedded once
+        positions: Dict[str, List[int]] = {}
+        for i, text in enumerate(texts):
+            if not text.strip():
+                result[i] = ZERO_EMBEDDING
+            else:
+                positions.setdefault(text, []).append(i)
+        unique_texts = list(positions)
         
-        if redis_client:
-            for i, text in enumerate(texts):
-                if not text.strip():
-                    # Handle empty text
-                    cache_hits[i] = [0.0] * DEFAULT_EMBEDDING_DIMENSION
-                    continue
-                    
-                cache_key = self._get_cache_key(text)
-                cached_embedding = redis_client.get(cache_key)
-                
+        if redis_client and unique_texts:
+            keys = await self._aget_cache_keys(unique_texts, tenant_id)
+            values = await self._get_cached_values(keys)
+            
+            # Warm cache with one distinct text per position: decode straight into the result
+            if len(unique_texts) == len(texts) and all(values):
+                dtype = self.cache_dtype
+                return [_deserialize_embedding(value, dtype) for value in values], [], [], [], len(texts)
+            
+            for text, key, cached_embedding in zip(unique_texts, keys, values):
                 if cached_embedding:
-                    cache_hits[i] = json.loads(cached_embedding)
+                    embedding = _deserialize_embedding(cached_embedding, self.cache_dtype)
+                    for i in positions[text]:
+                        result[i] = embedding
+                    cached_count += len(positions[text])
                 else:
                     texts_to_embed.append(text)
-                    original_indices.append(i)
+                    keys_to_embed.append(key)
+                    original_indices.append(positions[text])
         else:
             # No cache available, embed all non-empty texts
-            for i, text in enumerate(texts):
-                if not text.strip():
-                    cache_hits[i] = [0.0] * DEFAULT_EMBEDDING_DIMENSION
-                else:
-                    texts_to_embed.append(text)
-                    original_indices.append(i)
+            for text in unique_texts:
+                texts_to_embed.append(text)
+                original_indices.append(positions[text])
         
-        # If all texts were in cache, return them
-        if not texts_to_embed:
-            return [cache_hits[i] for i in range(len(texts))]
+        return result, texts_to_embed, keys_to_embed, original_indices, cached_count
+    
+    async def _get_cached_values(self, keys: List[str]) -> List[Optional[bytes]]:
+        """Read serialized embeddings from the local cache, then Redis for the rest."""
+        values = [self._local_cache.get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
         
-        # Get embeddings for texts not in cache
-        embeddings = self.openai_embed._get_text_embedding_batch(texts_to_embed)
+        if missing:
+            # Fetch the remaining embeddings in a single round-trip
+            fetched = await redis_client.mget([keys[i] for i in missing])
+            for i, value in zip(missing, fetched):
+                if value is not None:
+                    values[i] = value
+                    self._local_cache[keys[i]] = value
         
-        # Store new embeddings in cache
-        if redis_client:
-            for text_idx, embedding in zip(original_indices, embeddings):
-                text = texts[text_idx]
-                cache_key = self._get_cache_key(text)
-                redis_client.setex(
-                    cache_key,
-                    self.cache_ttl,
-                    json.dumps(embedding)
-                )
+        return values
+    
+    async def _store_cached(self, keys: List[str], embeddings: List[List[float]]) -> None:
+        """Store new embeddings under the keys computed during lookup, flushed as one pipeline."""
+        if not redis_client:
+            return
         
-        # Combine cached and new embeddings
-        result = [None] * len(texts)
+        pipe = redis_client.pipeline(transaction=False)
+        for key, embedding in zip(keys, embeddings):
+            value = _serialize_embedding(embedding, self.cache_dtype)
+            self._local_cache[key] = value
+            pipe.setex(key, self.cache_ttl, value)
+        await pipe.execute()
+    
+    def evict_local_cache(self, tenant_id: str) -> None:
+        """Drop a tenant's entries from this process's local cache."""
+        prefix = f"{self.cache_prefix}:{tenant_id}:"
+        for key in [key for key in self._local_cache if key.startswith(prefix)]:
+            self._local_cache.pop(key, None)
+
+# Coalesces cache misses from concurrent requests into shared OpenAI calls
+class EmbeddingMicroBatcher:
+    def __init__(
+        self,
+        embed_fn: Callable[[List[str]], Awaitable[List[List[float]]]],
+        window_ms: int = MICRO_BATCH_WINDOW_MS,
+        max_batch_size: int = EMBEDDING_BATCH_SIZE,
+        max_in_flight: int = MAX_IN_FLIGHT_BATCHES,
+    ):
+        self.embed_fn = embed_fn
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.max_in_flight = max_in_flight
+        self._queue: Optional[asyncio.Queue] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flushes: Set[asyncio.Task] = set()
+    
+    def start(self) -> None:
+        """Start the background drainer on the running event loop."""
+        self._queue = asyncio.Queue()
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self) -> None:
+        """Stop draining and wait for batches already sent to OpenAI."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
         
-        # Add cache hits
-        for idx, embedding in cache_hits.items():
-            result[idx] = embedding
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+    
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts, sharing the OpenAI call with other requests in the same window."""
+        if not texts:
+            return []
         
-        # Add new embeddings
-        for orig_idx, embedding in zip(original_indices, embeddings):
-            result[orig_idx] = embedding
+        # Outside the app lifecycle there is nothing draining the queue
+        if self._task is None:
+            return await self.embed_fn(texts)
         
-        return result
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((texts, future))
+        return await future
+    
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            batch_size = len(batch[0][0])
+            deadline = loop.time() + self.window
+            
+            # Keep collecting until the window closes or the batch is full
+            while batch_size < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                batch_size += len(item[0])
+            
+            # Bound the number of concurrent OpenAI calls
+            await self._semaphore.acquire()
+            flush = asyncio.create_task(self._flush(batch))
+            self._flushes.add(flush)
+            flush.add_done_callback(self._flushes.discard)
+    
+    async def _flush(self, batch: List[Tuple[List[str], asyncio.Future]]) -> None:
+        try:
+            texts = [text for item_texts, _ in batch for text in item_texts]
+            try:
+                embeddings = await self.embed_fn(texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            
+            # Hand each request back its own slice
+            offset = 0
+            for item_texts, future in batch:
+                end = offset + len(item_texts)
+                if not future.done():
+                    future.set_result(embeddings[offset:end])
+                offset = end
+        finally:
+            self._semaphore.release()
 
 # Initialize the embedding model
 embed_model = CachedOpenAIEmbedding(
     model_name=DEFAULT_EMBEDDING_MODEL,
     embed_batch_size=EMBEDDING_BATCH_SIZE,
     api_key=OPENAI_API_KEY,
-    cache_prefix="linktree-embed"
+    cache_prefix=EMBEDDING_CACHE_PREFIX,
+    http_client=http_client
 )
 
+embedding_batcher = EmbeddingMicroBatcher(embed_model._aembed_with_openai)
+
+@app.on_event("startup")
+async def connect_supabase():
+    global supabase
+    supabase = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+
+@app.on_event("startup")
+async def start_embedding_batcher():
+    embedding_batcher.start()
+
+@app.on_event("shutdown")
+async def stop_embedding_batcher():
+    await embedding_batcher.stop()
+    await http_client.aclose()
+    if redis_client:
+        await redis_client.aclose()
+
 # Pydantic models
 class TenantInfo(BaseModel):
     tenant_id: str
@@ -210,34 +509,103 @@ class EmbeddingResponse(BaseModel):
 
 # Dependency to verify tenant exists and subscription is active
 async def verify_tenant(tenant_id: str) -> TenantInfo:
-    tenant_data = supabase.table("tenants").select("*").eq("tenant_id", tenant_id).execute()
+    # Tenant and subscription data change rarely, serve recent checks from memory
+    cached = tenant_cache.get(tenant_id)
+    if cached:
+        return cached
     
-    if not tenant_data.data:
-        raise HTTPException(status_code=404, detail=f"Tenant {tenant_id} not found")
+    # Tenant and active subscription in a single round-trip
+    result = await supabase.rpc("verify_tenant", {"p_tenant_id": tenant_id}).execute()
     
-    # Check if subscription is active
-    subscription_data = supabase.table("tenant_subscriptions").select("*") \
-        .eq("tenant_id", tenant_id) \
-        .eq("is_active", True) \
-        .execute()
+    if not result.data:
+        raise HTTPException(status_code=404, detail=f"Tenant {tenant_id} not found")
     
-    if not subscription_data.data:
+    # The subscription side of the join is empty when none is active
+    subscription_tier = result.data[0].get("subscription_tier")
+    if not subscription_tier:
         raise HTTPException(status_code=403, detail=f"No active subscription for tenant {tenant_id}")
     
-    return TenantInfo(
+    tenant_info = TenantInfo(
         tenant_id=tenant_id,
-        subscription_tier=subscription_data.data[0]["subscription_tier"]
+        subscription_tier=subscription_tier
     )
+    tenant_cache[tenant_id] = tenant_info
+    return tenant_info
+
+# Record approximate token usage for the tenant
+async def increment_token_usage(tenant_id: str, tokens: int):
+    await supabase.rpc(
+        "increment_token_usage",
+        {
+            "p_tenant_id": tenant_id,
+            "p_tokens": tokens
+        }
+    ).execute()
+
+# Tokenizer of the default model, used for billing-accurate token counts
+try:
+    token_encoding = tiktoken.encoding_for_model(DEFAULT_EMBEDDING_MODEL)
+except KeyError:
+    token_encoding = tiktoken.get_encoding("cl100k_base")
+
+def count_tokens(texts: List[str]) -> int:
+    # The Rust tokenizer encodes the batch in parallel outside the GIL
+    return sum(len(ids) for ids in token_encoding.encode_ordinary_batch(texts, num_threads=8))
+
+# Token usage is buffered per tenant and flushed in the background, so metering
+# never adds a Supabase round-trip to a response
+pending_token_usage: Dict[str, int] = defaultdict(int)
+
+def record_token_usage(tenant_id: str, tokens: int):
+    pending_token_usage[tenant_id] += tokens
+
+async def flush_token_usage():
+    global pending_token_usage
+    if not pending_token_usage:
+        return
+    
+    usage, pending_token_usage = pending_token_usage, defaultdict(int)
+    results = await asyncio.gather(
+        *(increment_token_usage(tenant_id, tokens) for tenant_id, tokens in usage.items()),
+        return_exceptions=True
+    )
+    
+    # Keep failed increments for the next flush
+    for (tenant_id, tokens), result in zip(usage.items(), results):
+        if isinstance(result, Exception):
+            print(f"Error recording token usage for tenant {tenant_id}: {str(result)}")
+            pending_token_usage[tenant_id] += tokens
+
+async def token_usage_flusher():
+    while True:
+        await asyncio.sleep(TOKEN_USAGE_FLUSH_INTERVAL)
+        await flush_token_usage()
+
+@app.on_event("startup")
+async def start_token_usage_flusher():
+    app.state.token_usage_task = asyncio.create_task(token_usage_flusher())
+
+@app.on_event("shutdown")
+async def stop_token_usage_flusher():
+    app.state.token_usage_task.cancel()
+    try:
+        await app.state.token_usage_task
+    except asyncio.CancelledError:
+        pass
+    await flush_token_usage()
 
 # Rate limiter middleware
+EMBED_SUBROUTES = {"batch", "raw"}
+
 @app.middleware("http")
 async def rate_limit_middleware(request: Request, call_next):
     # Extract tenant_id from path or body
     tenant_id = None
     
     # Try to get from path params
+    # /embed/batch and /embed/raw are routes, not tenants, so their tenant comes from the body
     path_parts = request.url.path.split("/")
-    if len(path_parts) > 2 and path_parts[1] == "embed":
+    if len(path_parts) > 2 and path_parts[1] == "embed" and path_parts[2] not in EMBED_SUBROUTES:
         tenant_id = path_parts[2]
     
     # If not found in path, try to get from body for POST requests
@@ -249,21 +617,16 @@ async def rate_limit_middleware(request: Request, call_next):
             pass
     
     if tenant_id and redis_client:
-        # Check rate limit
+        # Count this request and check the limit in one atomic round-trip
         rate_key = f"ratelimit:{tenant_id}:minute"
-        current = redis_client.get(rate_key)
+        current = await rate_limit_script(keys=[rate_key], args=[RATE_LIMIT_WINDOW_SECONDS])
         
-        if current and int(current) > 600:  # 600 requests per minute max
-            return HTTPException(
+        if current > RATE_LIMIT_PER_MINUTE:
+            # Exceptions raised in middleware bypass FastAPI's handlers, so respond directly
+            return ORJSONResponse(
                 status_code=429,
-                detail="Rate limit exceeded. Try again later."
+                content={"detail": "Rate limit exceeded. Try again later."}
             )
-        
-        # Increment rate counter
-        pipe = redis_client.pipeline()
-        pipe.incr(rate_key)
-        pipe.expire(rate_key, 60)  # 1 minute TTL
-        pipe.execute()
     
     # Continue with the request
     return await call_next(request)
@@ -304,35 +667,23 @@ async def generate_embeddings(
     
     # Generate embeddings
     try:
-        if redis_client:
-            # Count cache hits for stats
-            cache_hits = 0
-            for text in request.texts:
-                cache_key = embed_model._get_cache_key(text)
-                if redis_client.exists(cache_key):
-                    cache_hits += 1
-        
-        # Generate embeddings
-        embeddings = embed_model._get_text_embedding_batch(request.texts)
-        
-        # Track token usage (approximate)
-        total_tokens = sum(len(text.split()) * 1.3 for text in request.texts)
-        supabase.rpc(
-            "increment_token_usage",
-            {
-                "p_tenant_id": request.tenant_id,
-                "p_tokens": int(total_tokens)
-            }
-        ).execute()
-        
-        return EmbeddingResponse(
-            success=True,
-            embeddings=embeddings,
-            model=model_name,
-            dimensions=len(embeddings[0]) if embeddings else DEFAULT_EMBEDDING_DIMENSION,
-            processing_time=time.time() - start_time,
-            cached_count=cache_hits if redis_client else 0
+        # Generate embeddings, counting cache hits for stats
+        embeddings, cache_hits = await embed_model.aget_text_embedding_batch_with_stats(
+            request.texts, request.tenant_id
         )
+        
+        # Track token usage
+        record_token_usage(request.tenant_id, count_tokens(request.texts))
+        
+        # Returned as a plain dict so the vectors skip Pydantic validation
+        return ORJSONResponse({
+            "success": True,
+            "embeddings": embeddings,
+            "model": model_name,
+            "dimensions": len(embeddings[0]) if embeddings else DEFAULT_EMBEDDING_DIMENSION,
+            "processing_time": time.time() - start_time,
+            "cached_count": cache_hits
+        })
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -366,34 +717,65 @@ async def batch_generate_embeddings(
     
     # Generate embeddings
     try:
-        if redis_client:
-            # Count cache hits for stats
-            cache_hits = 0
-            for text in texts:
-                cache_key = embed_model._get_cache_key(text)
-                if redis_client.exists(cache_key):
-                    cache_hits += 1
-        
-        # Generate embeddings
-        embeddings = embed_model._get_text_embedding_batch(texts)
-        
-        # Track token usage (approximate)
-        total_tokens = sum(len(text.split()) * 1.3 for text in texts)
-        supabase.rpc(
-            "increment_token_usage",
-            {
-                "p_tenant_id": request.tenant_id,
-                "p_tokens": int(total_tokens)
+        # Generate embeddings, counting cache hits for stats
+        embeddings, cache_hits = await embed_model.aget_text_embedding_batch_with_stats(
+            texts, request.tenant_id
+        )
+        
+        # Track token usage
+        record_token_usage(request.tenant_id, count_tokens(texts))
+        
+        # Returned as a plain dict so the vectors skip Pydantic validation
+        return ORJSONResponse({
+            "success": True,
+            "embeddings": embeddings,
+            "model": model_name,
+            "dimensions": len(embeddings[0]) if embeddings else DEFAULT_EMBEDDING_DIMENSION,
+            "processing_time": time.time() - start_time,
+            "cached_count": cache_hits
+        })
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error generating embeddings: {str(e)}"
+        )
+
+@app.post("/embed/raw")
+async def generate_embeddings_raw(
+    request: EmbeddingRequest,
+    tenant_info: TenantInfo = Depends(verify_tenant)
+):
+    """Return embeddings as packed little-endian float32, row-major, shape in headers."""
+    start_time = time.time()
+    
+    # Use requested model if specified and allowed for this tenant
+    model_name = DEFAULT_EMBEDDING_MODEL
+    if request.model and tenant_info.subscription_tier in ["pro", "business"]:
+        model_name = request.model
+    
+    # Generate embeddings
+    try:
+        # Generate embeddings, counting cache hits for stats
+        embeddings, cache_hits = await embed_model.aget_text_embedding_batch_with_stats(
+            request.texts, request.tenant_id
+        )
+        
+        # Track token usage
+        record_token_usage(request.tenant_id, count_tokens(request.texts))
+        
+        dimensions = len(embeddings[0]) if embeddings else DEFAULT_EMBEDDING_DIMENSION
+        matrix = np.asarray(embeddings, dtype="<f4").reshape(len(embeddings), dimensions)
+        
+        return Response(
+            content=matrix.tobytes(),
+            media_type="application/octet-stream",
+            headers={
+                "X-Embedding-Count": str(len(embeddings)),
+                "X-Embedding-Dimensions": str(dimensions),
+                "X-Embedding-Model": model_name,
+                "X-Cached-Count": str(cache_hits),
+                "X-Processing-Time": f"{time.time() - start_time:.6f}"
             }
-        ).execute()
-        
-        return EmbeddingResponse(
-            success=True,
-            embeddings=embeddings,
-            model=model_name,
-            dimensions=len(embeddings[0]) if embeddings else DEFAULT_EMBEDDING_DIMENSION,
-            processing_time=time.time() - start_time,
-            cached_count=cache_hits if redis_client else 0
         )
     except Exception as e:
         raise HTTPException(
@@ -435,12 +817,12 @@ async def list_available_models(tenant_info: TenantInfo = Depends(verify_tenant)
 async def get_service_status():
     try:
         # Check if Redis is available
-        redis_status = "available" if redis_client and redis_client.ping() else "unavailable"
+        redis_status = "available" if redis_client and await redis_client.ping() else "unavailable"
         
         # Check if Supabase is available
         supabase_status = "available"
         try:
-            supabase.table("tenants").select("tenant_id").limit(1).execute()
+            await supabase.table("tenants").select("tenant_id").limit(1).execute()
         except Exception:
             supabase_status = "unavailable"
         
@@ -448,7 +830,7 @@ async def get_service_status():
         openai_status = "available"
         try:
             # Quick test - generate a simple embedding
-            test_result = embed_model._get_text_embedding("test")
+            test_result = await embed_model._aget_text_embedding("test")
             if not test_result or len(test_result) < 10:
                 openai_status = "degraded"
         except Exception:
@@ -478,14 +860,14 @@ async def get_cache_stats(tenant_info: TenantInfo = Depends(verify_tenant)):
     
     try:
         # Get total keys in cache
-        total_keys = redis_client.dbsize()
+        total_keys = await redis_client.dbsize()
         
         # Get tenant-specific keys (if they're prefixed by tenant)
-        tenant_prefix = f"linktree-embed:{DEFAULT_EMBEDDING_MODEL}:"
+        tenant_prefix = f"{EMBEDDING_CACHE_PREFIX}:{tenant_info.tenant_id}:"
         tenant_keys = 0  # This is an approximation as we can't easily count by tenant
         
         # Get memory usage
-        memory_info = redis_client.info("memory")
+        memory_info = await redis_client.info("memory")
         used_memory = memory_info.get("used_memory_human", "unknown")
         
         return {
@@ -516,16 +898,21 @@ async def clear_tenant_cache(
         return {"status": "cache_unavailable"}
     
     try:
-        # We can't easily target just tenant's keys without a proper design
-        # This is a simplified approach - in production you'd want tenant isolation in cache keys
-        # Clear all embedding cache (dangerous in production!)
+        embed_model.evict_local_cache(tenant_id)
+        
+        # Cache keys are prefixed by tenant, so only this tenant's entries are scanned.
+        # UNLINK frees the values in a background thread instead of blocking Redis.
         cursor = 0
         deleted = 0
         
         while True:
-            cursor, keys = redis_client.scan(cursor, match=f"linktree-embed:*", count=100)
+            cursor, keys = await redis_client.scan(
+                cursor,
+                match=f"{EMBEDDING_CACHE_PREFIX}:{tenant_id}:*",
+                count=5000
+            )
             if keys:
-                deleted += redis_client.delete(*keys)
+                deleted += await redis_client.unlink(*keys)
             
             if cursor == 0:
                 break
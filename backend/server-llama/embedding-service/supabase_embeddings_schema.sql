@@ -15,6 +15,20 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+-- Tenant verification in one round-trip: no row means the tenant does not exist,
+-- a NULL subscription_tier means it has no active subscription
+CREATE OR REPLACE FUNCTION verify_tenant(
+    p_tenant_id UUID
+) RETURNS TABLE (tenant_id UUID, subscription_tier TEXT) AS $$
+    SELECT t.tenant_id, ts.subscription_tier
+    FROM public.tenants t
+    LEFT JOIN public.tenant_subscriptions ts
+        ON ts.tenant_id = t.tenant_id
+        AND ts.is_active = true
+    WHERE t.tenant_id = p_tenant_id
+    LIMIT 1;
+$$ LANGUAGE sql STABLE;
+
 -- Add embedding model preferences to tenant settings
 ALTER TABLE public.tenant_features
 ADD COLUMN IF NOT EXISTS preferred_embedding_model TEXT DEFAULT 'text-embedding-3-small';
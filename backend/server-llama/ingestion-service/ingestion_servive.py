@@ -1,12 +1,28 @@
 import os
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Callable, Awaitable, BinaryIO
+from contextlib import asynccontextmanager
 import uuid
-from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, UploadFile, File, Form
-from pydantic import BaseModel
+import asyncio
+import orjson
+import tempfile
+import hashlib
+import hmac
+import codecs
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, UploadFile, File, Form, Header
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, model_validator
 import httpx
-from supabase import create_client, Client
-import redis
+import numpy as np
+from supabase import acreate_client, AsyncClient
+from postgrest.exceptions import APIError
+import asyncpg
+from pgvector.asyncpg import register_vector
+import redis.asyncio as aioredis
 from redis.exceptions import ConnectionError
+from arq import create_pool, Retry
+from arq.connections import ArqRedis, RedisSettings
 
 # LlamaIndex imports
 from llama_index.core import (
@@ -15,35 +31,156 @@ from llama_index.core import (
     StorageContext,
     load_index_from_storage,
 )
-from llama_index.core.node_parser import SimpleNodeParser
+from llama_index.core.node_parser import SentenceSplitter
 from llama_index.core.schema import MetadataMode
 from llama_index.vector_stores.supabase import SupabaseVectorStore
 from llama_index.embeddings.openai import OpenAIEmbedding
 
 # FastAPI app
-app = FastAPI(title="Linktree AI - Ingestion Service")
+app = FastAPI(title="Linktree AI - Ingestion Service", default_response_class=ORJSONResponse)
 
 # Configuration
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
+DATABASE_URL = os.environ.get("DATABASE_URL")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379")
+INSERT_BATCH_SIZE = int(os.environ.get("INSERT_BATCH_SIZE", "500"))
+TENANT_CACHE_TTL = int(os.environ.get("TENANT_CACHE_TTL", "60"))
+TENANT_INVALIDATION_CHANNEL = "tenant:invalidate"
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "512"))
+EMBEDDING_CACHE_TTL = int(os.environ.get("EMBEDDING_CACHE_TTL", str(86400 * 7)))
+EMBEDDING_CACHE_DTYPE = os.environ.get("EMBEDDING_CACHE_DTYPE", "float32")
+FILE_MEMORY_THRESHOLD_MB = int(os.environ.get("FILE_MEMORY_THRESHOLD_MB", "8"))
+INGEST_CONCURRENCY = int(os.environ.get("INGEST_CONCURRENCY", "8"))
+INGEST_TENANT_CONCURRENCY = int(os.environ.get("INGEST_TENANT_CONCURRENCY", "2"))
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "20"))
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", "100"))
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", str(os.cpu_count() or 1)))
+INGEST_MAX_TRIES = int(os.environ.get("INGEST_MAX_TRIES", "5"))
+INGEST_RETRY_DELAY = int(os.environ.get("INGEST_RETRY_DELAY", "10"))
+INGEST_JOB_TIMEOUT = int(os.environ.get("INGEST_JOB_TIMEOUT", "600"))
+CHUNK_SIZE = int(os.environ.get("CHUNK_SIZE", "512"))
+CHUNK_OVERLAP = int(os.environ.get("CHUNK_OVERLAP", str(CHUNK_SIZE // 4)))
+
+if not 0 <= CHUNK_OVERLAP < CHUNK_SIZE:
+    raise ValueError(f"CHUNK_OVERLAP must be in [0, CHUNK_SIZE), got {CHUNK_OVERLAP}")
+
+if EMBEDDING_CACHE_DTYPE not in ("float32", "float16"):
+    raise ValueError(f"Unsupported EMBEDDING_CACHE_DTYPE: {EMBEDDING_CACHE_DTYPE}")
 
 # Redis connection for caching
 try:
-    redis_client = redis.from_url(REDIS_URL)
+    redis_client = aioredis.from_url(REDIS_URL)
 except ConnectionError:
     print("Warning: Redis connection failed. Running without cache.")
     redis_client = None
 
-# Supabase client
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Supabase client, created on startup since the async client is built in a coroutine
+supabase: Optional[AsyncClient] = None
+
+# Direct Postgres pool for hot tenant lookups and bulk chunk writes; asyncpg keeps each
+# query prepared per connection. None keeps everything on PostgREST
+db_pool: Optional[asyncpg.Pool] = None
+
+# Process pool for CPU-bound node parsing, so large batches don't block the event loop
+parse_pool: Optional[ProcessPoolExecutor] = None
+
+# arq queue for indexing jobs; None falls back to in-process BackgroundTasks
+arq_pool: Optional[ArqRedis] = None
+
+# Shared keep-alive HTTP/2 client for OpenAI, so embedding calls reuse open connections
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=30.0,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+)
 
 # OpenAI Embedding model
+EMBEDDING_MODEL = "text-embedding-3-small"
 embed_model = OpenAIEmbedding(
-    model_name="text-embedding-3-small",
+    model_name=EMBEDDING_MODEL,
     api_key=OPENAI_API_KEY,
-    embed_batch_size=100  # Process 100 texts at once for efficiency
+    embed_batch_size=EMBEDDING_BATCH_SIZE,  # Chunks per request, kept under OpenAI's per-request token cap
+    async_http_client=http_client
+)
+
+@app.on_event("startup")
+async def connect_supabase():
+    global supabase
+    supabase = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+
+@app.on_event("startup")
+async def connect_database():
+    global db_pool
+    if not DATABASE_URL:
+        return
+    try:
+        db_pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=1,
+            max_size=DB_POOL_SIZE,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            init=register_vector
+        )
+    except Exception as e:
+        print(f"Warning: database connection failed, using PostgREST only: {str(e)}")
+        db_pool = None
+
+@app.on_event("startup")
+async def start_parse_pool():
+    global parse_pool
+    if PARSE_WORKERS > 1:
+        parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+
+@app.on_event("startup")
+async def connect_queue():
+    global arq_pool
+    try:
+        arq_pool = await create_pool(RedisSettings.from_dsn(REDIS_URL))
+    except Exception as e:
+        print(f"Warning: job queue unavailable, indexing in-process: {str(e)}")
+        arq_pool = None
+
+@app.on_event("shutdown")
+async def close_queue():
+    if arq_pool:
+        await arq_pool.close()
+    if db_pool:
+        await db_pool.close()
+    if parse_pool:
+        parse_pool.shutdown(cancel_futures=True)
+    await http_client.aclose()
+
+# Bound concurrent indexing jobs per process, with a per-tenant limit so one tenant
+# can't take every slot
+ingest_semaphore = asyncio.Semaphore(INGEST_CONCURRENCY)
+
+# Per-tenant semaphores exist only while a job of the tenant is running or waiting, so
+# idle tenants don't accumulate. The count includes waiters, so an entry is never
+# dropped while someone is queued on it
+tenant_ingest_semaphores: Dict[str, asyncio.Semaphore] = {}
+tenant_ingest_users: Dict[str, int] = {}
+
+@asynccontextmanager
+async def tenant_ingest_slot(tenant_id: str):
+    semaphore = tenant_ingest_semaphores.get(tenant_id)
+    if semaphore is None:
+        semaphore = tenant_ingest_semaphores[tenant_id] = asyncio.Semaphore(INGEST_TENANT_CONCURRENCY)
+    tenant_ingest_users[tenant_id] = tenant_ingest_users.get(tenant_id, 0) + 1
+    try:
+        async with semaphore:
+            yield
+    finally:
+        tenant_ingest_users[tenant_id] -= 1
+        if not tenant_ingest_users[tenant_id]:
+            del tenant_ingest_users[tenant_id]
+            del tenant_ingest_semaphores[tenant_id]
+
+# Node parser, built once and shared across documents
+node_parser = SentenceSplitter(
+    chunk_size=CHUNK_SIZE,
+    chunk_overlap=CHUNK_OVERLAP
 )
 
 # Pydantic models
@@ -64,6 +201,17 @@ class DocumentIngestionRequest(BaseModel):
     documents: List[str] = []  # Text content of documents
     document_metadatas: List[DocumentMetadata] = []  # Metadata for each document
     collection_name: Optional[str] = "default"  # Collection/namespace for the documents
+    
+    # Reject malformed batches during body validation, before any tenant lookup
+    @model_validator(mode="after")
+    def check_batch(self) -> "DocumentIngestionRequest":
+        if not self.documents:
+            raise ValueError("At least one document is required")
+        if len(self.documents) != len(self.document_metadatas):
+            raise ValueError("Number of documents must match number of metadata objects")
+        if any(not doc_text.strip() for doc_text in self.documents):
+            raise ValueError("Documents must not be empty")
+        return self
 
 class IngestionResponse(BaseModel):
     success: bool
@@ -71,55 +219,145 @@ class IngestionResponse(BaseModel):
     document_ids: List[str]
     nodes_count: int
 
+# Batched Redis access: one MGET per read and one pipelined round-trip per write,
+# treating every key as a miss when Redis is unavailable
+async def cache_mget(keys: List[str]) -> List[Optional[bytes]]:
+    if redis_client and keys:
+        try:
+            return await redis_client.mget(keys)
+        except Exception as e:
+            print(f"Error reading {len(keys)} cache keys: {str(e)}")
+    
+    return [None] * len(keys)
+
+async def cache_set_many(items: Dict[str, bytes], ttl: int):
+    if not redis_client or not items:
+        return
+    
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for key, value in items.items():
+            pipe.setex(key, ttl, value)
+        await pipe.execute()
+    except Exception as e:
+        print(f"Error writing {len(items)} cache keys: {str(e)}")
+
+# Read-through Redis cache for tenant metadata, falling back to fetch_fn when Redis is unavailable
+async def _cached(key: str, ttl: int, fetch_fn: Callable[[], Awaitable[Any]]) -> Any:
+    cached = (await cache_mget([key]))[0]
+    if cached is not None:
+        return orjson.loads(cached)
+    
+    result = await fetch_fn()
+    await cache_set_many({key: orjson.dumps(result)}, ttl)
+    
+    return result
+
+# Dependency for internal endpoints: the caller must present the Supabase service key
+# as a bearer token
+async def verify_service_key(authorization: Optional[str] = Header(None)):
+    scheme, _, token = (authorization or "").partition(" ")
+    if not SUPABASE_KEY or scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), SUPABASE_KEY.encode()):
+        raise HTTPException(status_code=401, detail="Invalid service key")
+
 # Dependency to verify tenant exists and subscription is active
 async def verify_tenant(tenant_id: str) -> TenantInfo:
-    tenant_data = supabase.table("tenants").select("*").eq("tenant_id", tenant_id).execute()
+    tier = await _cached(
+        f"tenant:{tenant_id}",
+        TENANT_CACHE_TTL,
+        lambda: fetch_subscription_tier(tenant_id)
+    )
+    
+    return TenantInfo(tenant_id=tenant_id, subscription_tier=tier)
+
+async def fetch_subscription_tier(tenant_id: str) -> str:
+    if db_pool:
+        # One prepared join over the direct pool; no row means an unknown tenant and a
+        # NULL tier means no active subscription
+        row = await db_pool.fetchrow(
+            "SELECT s.subscription_tier FROM tenants t "
+            "LEFT JOIN tenant_subscriptions s ON s.tenant_id = t.tenant_id AND s.is_active "
+            "WHERE t.tenant_id = $1 LIMIT 1",
+            tenant_id
+        )
+        if row is None:
+            raise HTTPException(status_code=404, detail=f"Tenant {tenant_id} not found")
+        if row["subscription_tier"] is None:
+            raise HTTPException(status_code=403, detail=f"No active subscription for tenant {tenant_id}")
+        return row["subscription_tier"]
+    
+    # Tenant and active subscription lookups are independent, so run them together
+    tenant_data, subscription_data = await asyncio.gather(
+        supabase.table("tenants").select("*").eq("tenant_id", tenant_id).execute(),
+        supabase.table("tenant_subscriptions").select("*") \
+            .eq("tenant_id", tenant_id) \
+            .eq("is_active", True) \
+            .execute()
+    )
     
     if not tenant_data.data:
         raise HTTPException(status_code=404, detail=f"Tenant {tenant_id} not found")
     
-    # Check if subscription is active
-    subscription_data = supabase.table("tenant_subscriptions").select("*") \
-        .eq("tenant_id", tenant_id) \
-        .eq("is_active", True) \
-        .execute()
-    
     if not subscription_data.data:
         raise HTTPException(status_code=403, detail=f"No active subscription for tenant {tenant_id}")
     
-    return TenantInfo(
-        tenant_id=tenant_id,
-        subscription_tier=subscription_data.data[0]["subscription_tier"]
-    )
+    return subscription_data.data[0]["subscription_tier"]
 
 # Check tenant quotas
 async def check_tenant_quotas(tenant_info: TenantInfo) -> bool:
-    # Get tenant's current usage
-    usage_data = supabase.table("tenant_stats").select("*") \
-        .eq("tenant_id", tenant_info.tenant_id) \
-        .execute()
+    # Get tenant's current usage and the limits for their tier; usage changes on
+    # every ingestion so only the tier limits are cached
+    document_count, limits = await asyncio.gather(
+        fetch_document_count(tenant_info.tenant_id),
+        _cached(
+            f"tier:{tenant_info.subscription_tier}",
+            TENANT_CACHE_TTL,
+            lambda: fetch_tier_limits(tenant_info.subscription_tier)
+        )
+    )
     
-    if not usage_data.data:
+    if document_count is None:
         # No usage data yet, they're under quota
         return True
     
-    current_usage = usage_data.data[0]
+    # Check document count
+    if document_count >= limits["max_docs"]:
+        raise HTTPException(status_code=429, detail="Document limit reached for your subscription tier")
+    
+    return True
+
+async def fetch_document_count(tenant_id: str) -> Optional[int]:
+    if db_pool:
+        return await db_pool.fetchval(
+            "SELECT document_count FROM tenant_stats WHERE tenant_id = $1",
+            tenant_id
+        )
     
-    # Get limits based on subscription tier
-    tier_limits = supabase.table("tenant_features").select("*") \
-        .eq("tier", tenant_info.subscription_tier) \
+    usage_data = await supabase.table("tenant_stats").select("document_count") \
+        .eq("tenant_id", tenant_id) \
         .execute()
     
-    if not tier_limits.data:
-        raise HTTPException(status_code=500, detail="Subscription tier limits not found")
+    return usage_data.data[0]["document_count"] if usage_data.data else None
+
+async def fetch_tier_limits(tier: str) -> Dict[str, Any]:
+    if db_pool:
+        row = await db_pool.fetchrow(
+            "SELECT tier, max_docs, max_knowledge_bases, has_advanced_rag, max_tokens_per_month "
+            "FROM tenant_features WHERE tier = $1",
+            tier
+        )
+        if row is None:
+            raise HTTPException(status_code=500, detail="Subscription tier limits not found")
+        return dict(row)
     
-    limits = tier_limits.data[0]
+    tier_limits = await supabase.table("tenant_features").select("*") \
+        .eq("tier", tier) \
+        .execute()
     
-    # Check document count
-    if current_usage["document_count"] >= limits["max_docs"]:
-        raise HTTPException(status_code=429, detail="Document limit reached for your subscription tier")
+    if not tier_limits.data:
+        raise HTTPException(status_code=500, detail="Subscription tier limits not found")
     
-    return True
+    return tier_limits.data[0]
 
 # Function to get vector store for a tenant
 def get_tenant_vector_store(tenant_id: str, collection_name: str) -> SupabaseVectorStore:
@@ -134,128 +372,331 @@ def get_tenant_vector_store(tenant_id: str, collection_name: str) -> SupabaseVec
     
     return vector_store
 
-# Process document and create nodes
-def process_document(
+# Decode a UTF-8 stream a block at a time, cutting sections at the last newline (or
+# space, for text without line breaks) of each block so the whole body is never held as
+# bytes and a joined str at once
+def decode_sections(raw: BinaryIO, block_size: int = 1 << 20) -> List[str]:
+    sections = []
+    tail = ""
+    for text in codecs.iterdecode(iter(lambda: raw.read(block_size), b""), "utf-8", errors="replace"):
+        text = tail + text
+        cut = (text.rfind("\n") + 1) or (text.rfind(" ") + 1) or len(text)
+        sections.append(text[:cut])
+        tail = text[cut:]
+    
+    if tail:
+        sections.append(tail)
+    
+    return sections
+
+# Read an uploaded file into text sections. Small files are decoded incrementally from
+# the spooled upload; larger ones are streamed to a temp file and loaded with
+# SimpleDirectoryReader so the file-type-aware readers apply
+async def read_upload(file: UploadFile) -> List[str]:
+    if file.size is not None and file.size <= FILE_MEMORY_THRESHOLD_MB * 1024 * 1024:
+        return await asyncio.to_thread(decode_sections, file.file)
+    
+    suffix = os.path.splitext(file.filename or "")[1]
+    tmp = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+    try:
+        with tmp:
+            while chunk := await file.read(1 << 20):
+                tmp.write(chunk)
+        
+        reader = SimpleDirectoryReader(input_files=[tmp.name])
+        documents = await asyncio.to_thread(reader.load_data)
+        return [document.text for document in documents]
+    finally:
+        os.unlink(tmp.name)
+
+# Build a LlamaIndex document carrying the chunk metadata. Chunks are embedded without
+# their metadata, so every key is excluded and the splitter doesn't reserve room for it
+def build_document(
     doc_text: str, 
     metadata: DocumentMetadata,
     collection_name: str
-) -> List[Dict[str, Any]]:
-    # Create a LlamaIndex document
-    document = Document(
+) -> Document:
+    doc_metadata = {
+        "tenant_id": metadata.tenant_id,
+        "source": metadata.source,
+        "author": metadata.author,
+        "created_at": metadata.created_at,
+        "document_type": metadata.document_type,
+        "collection": collection_name,
+        **(metadata.custom_metadata or {})
+    }
+    
+    return Document(
         text=doc_text,
-        metadata={
-            "tenant_id": metadata.tenant_id,
-            "source": metadata.source,
-            "author": metadata.author,
-            "created_at": metadata.created_at,
-            "document_type": metadata.document_type,
-            "collection": collection_name,
-            **(metadata.custom_metadata or {})
-        }
+        metadata=doc_metadata,
+        excluded_embed_metadata_keys=list(doc_metadata),
+        excluded_llm_metadata_keys=list(doc_metadata)
     )
+
+# Process documents and create nodes, parsing the whole batch in one pass
+def process_documents(documents: List[Document]) -> List[Dict[str, Any]]:
+    nodes = node_parser.get_nodes_from_documents(documents)
+    
+    # Nodes of a document share its metadata dict rather than each keeping a copy;
+    # pickling the job for the queue then also writes it once per document
+    doc_metadata = {document.doc_id: document.metadata for document in documents}
+    
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "text": node.get_content(metadata_mode=MetadataMode.NONE),
+            "metadata": doc_metadata.get(node.ref_doc_id, node.metadata)
+        }
+        for node in nodes
+    ]
+
+# Parse documents across the process pool, one contiguous group per worker. A single
+# document is parsed inline since the IPC would cost more than it saves
+async def parse_documents(documents: List[Document]) -> List[Dict[str, Any]]:
+    if parse_pool is None or len(documents) < 2:
+        return process_documents(documents)
+    
+    loop = asyncio.get_running_loop()
+    group_size = -(-len(documents) // PARSE_WORKERS)
+    groups = await asyncio.gather(*[
+        loop.run_in_executor(parse_pool, process_documents, documents[i:i + group_size])
+        for i in range(0, len(documents), group_size)
+    ])
+    
+    return [node for group in groups for node in group]
+
+# Upsert a slice of chunk rows, retrying row by row if the bulk request fails. Rows are
+# keyed by node id, so a retried job rewrites its chunks instead of duplicating them
+async def insert_chunks(rows: List[Dict[str, Any]]):
+    try:
+        await supabase.table("document_chunks").upsert(rows).execute()
+    except Exception as e:
+        print(f"Bulk insert of {len(rows)} chunks failed, retrying individually: {str(e)}")
+        for row in rows:
+            try:
+                await supabase.table("document_chunks").upsert(row).execute()
+            except Exception as row_error:
+                print(f"Error inserting chunk {row['id']}: {str(row_error)}")
+
+# Queue documents for indexing, on the arq worker when available
+async def schedule_indexing(
+    background_tasks: BackgroundTasks,
+    node_data_list: List[Dict[str, Any]],
+    tenant_id: str,
+    collection_name: str
+):
+    if arq_pool:
+        await arq_pool.enqueue_job(
+            "index_documents_worker",
+            node_data_list,
+            tenant_id,
+            collection_name
+        )
+    else:
+        background_tasks.add_task(
+            index_documents_task,
+            node_data_list,
+            tenant_id,
+            collection_name
+        )
+
+# Write chunk rows with a binary COPY, sending embeddings as fixed-width float32 instead
+# of JSON text. Existing rows with the same ids are removed first so a retried job
+# doesn't hit duplicate keys. Returns False when the REST path should be used instead
+async def copy_chunks(rows: List[Dict[str, Any]]) -> bool:
+    if not db_pool:
+        return False
     
-    # Parse document into nodes
-    parser = SimpleNodeParser.from_defaults(
-        chunk_size=512,
-        chunk_overlap=50
-    )
+    try:
+        async with db_pool.acquire() as conn, conn.transaction():
+            await conn.execute(
+                "DELETE FROM ai.document_chunks WHERE id = ANY($1::uuid[])",
+                [row["id"] for row in rows]
+            )
+            await conn.copy_records_to_table(
+                "document_chunks",
+                schema_name="ai",
+                columns=["id", "tenant_id", "content", "metadata", "embedding"],
+                records=[
+                    (row["id"], row["tenant_id"], row["content"], orjson.dumps(row["metadata"]).decode(), row["embedding"])
+                    for row in rows
+                ]
+            )
+        return True
+    except Exception as e:
+        print(f"COPY of {len(rows)} chunks failed, falling back to REST: {str(e)}")
+        return False
+
+# Embed chunk texts, reusing cached embeddings for chunk text the tenant has indexed
+# before (repeated headers, footers, boilerplate). Vectors are cached as raw
+# EMBEDDING_CACHE_DTYPE bytes keyed by a hash of the text, and only texts that miss are
+# sent to OpenAI. The dtype is part of the key so changing it never misreads old entries.
+# float16 is lossy: the vectors written to document_chunks are float16-rounded, and fresh
+# vectors are rounded the same way so a text indexes identically on a hit and a miss
+async def embed_texts(texts: List[str], tenant_id: str) -> List[List[float]]:
+    if not redis_client:
+        return await embed_model.aget_text_embedding_batch(texts)
+    
+    keys = [
+        f"emb:{EMBEDDING_MODEL}:{EMBEDDING_CACHE_DTYPE}:{tenant_id}:{hashlib.blake2b(text.encode(), digest_size=16).hexdigest()}"
+        for text in texts
+    ]
+    
+    cached = await cache_mget(keys)
+    
+    embeddings: List[Optional[List[float]]] = [
+        np.frombuffer(raw, dtype=EMBEDDING_CACHE_DTYPE).tolist() if raw is not None else None
+        for raw in cached
+    ]
+    
+    # Identical texts share a key, so each distinct miss is embedded once
+    missing = {key: text for key, text, embedding in zip(keys, texts, embeddings) if embedding is None}
+    if not missing:
+        return embeddings
+    
+    fresh_vectors = dict(zip(
+        missing,
+        (
+            np.asarray(embedding, dtype=EMBEDDING_CACHE_DTYPE)
+            for embedding in await embed_model.aget_text_embedding_batch(list(missing.values()))
+        )
+    ))
     
-    nodes = parser.get_nodes_from_documents([document])
+    await cache_set_many(
+        {key: vector.tobytes() for key, vector in fresh_vectors.items()},
+        EMBEDDING_CACHE_TTL
+    )
     
-    # Process all nodes and return node data
-    node_data = []
-    for node in nodes:
-        node_id = str(uuid.uuid4())
-        node_text = node.get_content(metadata_mode=MetadataMode.NONE)
-        node_metadata = node.metadata
-        
-        node_data.append({
-            "id": node_id,
-            "text": node_text,
-            "metadata": node_metadata
-        })
+    fresh = {key: vector.tolist() for key, vector in fresh_vectors.items()}
     
-    return node_data
+    return [
+        embedding if embedding is not None else fresh[key]
+        for key, embedding in zip(keys, embeddings)
+    ]
 
-# Background task to index documents
+# Background task to index documents, used when the job queue is unavailable
 async def index_documents_task(
     node_data_list: List[Dict[str, Any]],
     tenant_id: str,
     collection_name: str
 ):
-    try:
-        # Get vector store for tenant
-        vector_store = get_tenant_vector_store(tenant_id, collection_name)
-        
-        # Extract texts for batch embedding
-        texts = [node["text"] for node in node_data_list]
-        
-        # Generate embeddings in batch
-        embeddings = embed_model.get_text_embedding_batch(texts)
-        
-        # Add each node to vector store
-        for i, node_data in enumerate(node_data_list):
-            # Add document chunk to Supabase
-            supabase.table("document_chunks").insert({
-                "id": node_data["id"],
-                "tenant_id": tenant_id,
-                "content": node_data["text"],
-                "metadata": node_data["metadata"],
-                "embedding": embeddings[i]
-            }).execute()
-        
-        # Update document count for tenant
-        supabase.rpc(
-            "increment_document_count",
-            {"p_tenant_id": tenant_id, "p_count": 1}
-        ).execute()
-        
-        print(f"Successfully indexed {len(node_data_list)} nodes for tenant {tenant_id}")
-    except Exception as e:
-        print(f"Error indexing documents: {str(e)}")
-        # Log error to monitoring system
+    # Take the tenant slot first so a tenant at its own limit doesn't hold a global slot
+    async with tenant_ingest_slot(tenant_id), ingest_semaphore:
+        try:
+            await index_documents(node_data_list, tenant_id, collection_name)
+        except Exception as e:
+            print(f"Error indexing documents: {str(e)}")
+            # Log error to monitoring system
+
+# arq job to index documents; failures are retried with a growing delay up to
+# INGEST_MAX_TRIES. Global concurrency is bounded by the worker's max_jobs
+async def index_documents_worker(
+    ctx: Dict[str, Any],
+    node_data_list: List[Dict[str, Any]],
+    tenant_id: str,
+    collection_name: str
+):
+    async with tenant_ingest_slot(tenant_id):
+        try:
+            await index_documents(node_data_list, tenant_id, collection_name)
+        except Exception as e:
+            print(f"Error indexing documents (try {ctx['job_try']}): {str(e)}")
+            raise Retry(defer=INGEST_RETRY_DELAY * ctx["job_try"])
+
+async def index_documents(
+    node_data_list: List[Dict[str, Any]],
+    tenant_id: str,
+    collection_name: str
+):
+    # Get vector store for tenant
+    vector_store = get_tenant_vector_store(tenant_id, collection_name)
+    
+    # Extract texts for batch embedding
+    texts = [node["text"] for node in node_data_list]
+    
+    # Generate embeddings in batch, skipping chunks already in the cache
+    embeddings = await embed_texts(texts, tenant_id)
+    
+    rows = [
+        {
+            "id": node_data["id"],
+            "tenant_id": tenant_id,
+            "content": node_data["text"],
+            "metadata": node_data["metadata"],
+            "embedding": embedding
+        }
+        for node_data, embedding in zip(node_data_list, embeddings)
+    ]
+    
+    # Insert chunks in bulk, one request per slice to stay under PostgREST payload limits
+    if not await copy_chunks(rows):
+        rows_iter = iter(rows)
+        while batch := list(islice(rows_iter, INSERT_BATCH_SIZE)):
+            await insert_chunks(batch)
+    
+    # Update document count for tenant, once for every document in the job
+    document_count = len({node["metadata"]["document_id"] for node in node_data_list})
+    await supabase.rpc(
+        "increment_document_count",
+        {"p_tenant_id": tenant_id, "p_count": document_count}
+    ).execute()
+    
+    print(f"Successfully indexed {len(node_data_list)} nodes for tenant {tenant_id}")
+
+async def worker_startup(ctx: Dict[str, Any]):
+    await connect_supabase()
+    await connect_database()
+
+async def worker_shutdown(ctx: Dict[str, Any]):
+    if db_pool:
+        await db_pool.close()
+    await http_client.aclose()
+
+# Run with: arq ingestion_servive.WorkerSettings
+class WorkerSettings:
+    functions = [index_documents_worker]
+    on_startup = worker_startup
+    on_shutdown = worker_shutdown
+    redis_settings = RedisSettings.from_dsn(REDIS_URL)
+    max_jobs = INGEST_CONCURRENCY
+    max_tries = INGEST_MAX_TRIES
+    job_timeout = INGEST_JOB_TIMEOUT
 
 # API endpoints
 @app.post("/ingest", response_model=IngestionResponse)
 async def ingest_documents(
     request: DocumentIngestionRequest,
-    background_tasks: BackgroundTasks,
-    tenant_info: TenantInfo = Depends(verify_tenant)
+    background_tasks: BackgroundTasks
 ):
+    # The body is validated by now, so only well-formed batches reach Supabase
+    tenant_info = await verify_tenant(request.tenant_id)
+    
     # Check quotas
     await check_tenant_quotas(tenant_info)
     
-    if len(request.documents) != len(request.document_metadatas):
-        raise HTTPException(
-            status_code=400, 
-            detail="Number of documents must match number of metadata objects"
-        )
-    
     document_ids = []
-    all_nodes = []
+    documents = []
     
-    # Process each document
-    for i, doc_text in enumerate(request.documents):
-        metadata = request.document_metadatas[i]
+    for doc_text, metadata in zip(request.documents, request.document_metadatas):
         doc_id = str(uuid.uuid4())
         document_ids.append(doc_id)
         
-        # Add document ID to metadata
+        # Add document ID to metadata so every node can be traced back to its document
         metadata.custom_metadata = metadata.custom_metadata or {}
         metadata.custom_metadata["document_id"] = doc_id
         
-        # Process document to get nodes
-        node_data = process_document(
+        documents.append(build_document(
             doc_text=doc_text,
             metadata=metadata,
             collection_name=request.collection_name
-        )
-        
-        all_nodes.extend(node_data)
+        ))
+    
+    # Parse all documents to nodes, split across the parse pool
+    all_nodes = await parse_documents(documents)
     
-    # Schedule background task to index documents
-    background_tasks.add_task(
-        index_documents_task,
+    # Queue the nodes for indexing
+    await schedule_indexing(
+        background_tasks,
         all_nodes,
         request.tenant_id,
         request.collection_name
@@ -282,8 +723,7 @@ async def ingest_file(
     await check_tenant_quotas(tenant_info)
     
     # Read file content
-    content = await file.read()
-    file_text = content.decode("utf-8")
+    file_sections = await read_upload(file)
     
     # Create metadata
     metadata = DocumentMetadata(
@@ -303,15 +743,18 @@ async def ingest_file(
     metadata.custom_metadata["document_id"] = doc_id
     
     # Process document to get nodes
-    node_data = process_document(
-        doc_text=file_text,
-        metadata=metadata,
-        collection_name=collection_name
-    )
+    node_data = await parse_documents([
+        build_document(
+            doc_text=section,
+            metadata=metadata,
+            collection_name=collection_name
+        )
+        for section in file_sections
+    ])
     
-    # Schedule background task to index documents
-    background_tasks.add_task(
-        index_documents_task,
+    # Queue the nodes for indexing
+    await schedule_indexing(
+        background_tasks,
         node_data,
         tenant_id,
         collection_name
@@ -330,23 +773,40 @@ async def delete_document(
     document_id: str,
     tenant_info: TenantInfo = Depends(verify_tenant)
 ):
-    # Delete document chunks
-    result = supabase.table("document_chunks").delete() \
+    # Delete document chunks and update the document count in one call
+    try:
+        result = await supabase.rpc(
+            "delete_document_chunks",
+            {"p_tenant_id": tenant_id, "p_document_id": document_id}
+        ).execute()
+        deleted_chunks = result.data[0]["deleted_chunks"] if result.data else 0
+    except APIError as e:
+        # PGRST202: the function isn't deployed yet, so delete over REST and count here
+        if e.code != "PGRST202":
+            raise
+        deleted_chunks = await delete_document_rest(tenant_id, document_id)
+    
+    return {
+        "success": True,
+        "message": f"Document {document_id} deleted",
+        "deleted_chunks": deleted_chunks
+    }
+
+async def delete_document_rest(tenant_id: str, document_id: str) -> int:
+    result = await supabase.table("document_chunks").delete() \
         .eq("tenant_id", tenant_id) \
         .eq("metadata->>document_id", document_id) \
         .execute()
     
-    # Update document count for tenant
-    supabase.rpc(
+    if not result.data:
+        return 0
+    
+    await supabase.rpc(
         "decrement_document_count",
         {"p_tenant_id": tenant_id, "p_count": 1}
     ).execute()
     
-    return {
-        "success": True,
-        "message": f"Document {document_id} deleted",
-        "deleted_chunks": len(result.data) if result.data else 0
-    }
+    return len(result.data)
 
 @app.delete("/collections/{tenant_id}/{collection_name}")
 async def delete_collection(
@@ -354,26 +814,57 @@ async def delete_collection(
     collection_name: str,
     tenant_info: TenantInfo = Depends(verify_tenant)
 ):
-    # Delete document chunks for this collection
-    result = supabase.table("document_chunks").delete() \
+    # Delete the collection's chunks and decrement the document count server-side,
+    # so only the counts come back over the wire
+    try:
+        result = await supabase.rpc(
+            "delete_collection_chunks",
+            {"p_tenant_id": tenant_id, "p_collection": collection_name}
+        ).execute()
+        deleted_chunks = result.data[0]["deleted_chunks"] if result.data else 0
+    except APIError as e:
+        # PGRST202: the function isn't deployed yet, so delete over REST and count here
+        if e.code != "PGRST202":
+            raise
+        deleted_chunks = await delete_collection_rest(tenant_id, collection_name)
+    
+    return {
+        "success": True,
+        "message": f"Collection {collection_name} deleted for tenant {tenant_id}",
+        "deleted_chunks": deleted_chunks
+    }
+
+async def delete_collection_rest(tenant_id: str, collection_name: str) -> int:
+    result = await supabase.table("document_chunks").delete() \
         .eq("tenant_id", tenant_id) \
         .eq("metadata->>collection", collection_name) \
         .execute()
     
-    # Update document count for tenant
-    if result.data and len(result.data) > 0:
-        # Estimate document count (this is approximate)
-        doc_count = len(set([item["metadata"]["document_id"] for item in result.data if "document_id" in item["metadata"]]))
-        
-        supabase.rpc(
+    if not result.data:
+        return 0
+    
+    document_ids = {item["metadata"].get("document_id") for item in result.data}
+    document_ids.discard(None)
+    
+    if document_ids:
+        await supabase.rpc(
             "decrement_document_count",
-            {"p_tenant_id": tenant_id, "p_count": doc_count}
+            {"p_tenant_id": tenant_id, "p_count": len(document_ids)}
         ).execute()
     
+    return len(result.data)
+
+@app.delete("/cache/tenants/{tenant_id}", dependencies=[Depends(verify_service_key)])
+async def invalidate_tenant_cache(tenant_id: str):
+    """Drop cached tenant metadata, called when a subscription changes"""
+    if redis_client:
+        await redis_client.delete(f"tenant:{tenant_id}")
+        # Query service replicas sharing this Redis drop their local copies on this message
+        await redis_client.publish(TENANT_INVALIDATION_CHANNEL, tenant_id)
+    
     return {
         "success": True,
-        "message": f"Collection {collection_name} deleted for tenant {tenant_id}",
-        "deleted_chunks": len(result.data) if result.data else 0
+        "message": f"Cache invalidated for tenant {tenant_id}"
     }
 
 if __name__ == "__main__":
@@ -92,6 +92,55 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+-- Delete a collection's chunks and decrement the document count in one round-trip,
+-- returning only the counts instead of every deleted row
+CREATE OR REPLACE FUNCTION delete_collection_chunks(
+    p_tenant_id UUID,
+    p_collection TEXT
+) RETURNS TABLE (deleted_chunks INTEGER, deleted_docs INTEGER) AS $$
+BEGIN
+    WITH del AS (
+        DELETE FROM ai.document_chunks
+        WHERE tenant_id = p_tenant_id
+          AND metadata->>'collection' = p_collection
+        RETURNING metadata->>'document_id' AS document_id
+    )
+    SELECT count(*)::INTEGER, count(DISTINCT document_id)::INTEGER
+    INTO deleted_chunks, deleted_docs
+    FROM del;
+
+    IF deleted_docs > 0 THEN
+        PERFORM decrement_document_count(p_tenant_id, deleted_docs);
+    END IF;
+
+    RETURN NEXT;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Same as delete_collection_chunks, for the chunks of a single document
+CREATE OR REPLACE FUNCTION delete_document_chunks(
+    p_tenant_id UUID,
+    p_document_id TEXT
+) RETURNS TABLE (deleted_chunks INTEGER, deleted_docs INTEGER) AS $$
+BEGIN
+    WITH del AS (
+        DELETE FROM ai.document_chunks
+        WHERE tenant_id = p_tenant_id
+          AND metadata->>'document_id' = p_document_id
+        RETURNING 1
+    )
+    SELECT count(*)::INTEGER INTO deleted_chunks FROM del;
+
+    deleted_docs := CASE WHEN deleted_chunks > 0 THEN 1 ELSE 0 END;
+
+    IF deleted_docs > 0 THEN
+        PERFORM decrement_document_count(p_tenant_id, deleted_docs);
+    END IF;
+
+    RETURN NEXT;
+END;
+$$ LANGUAGE plpgsql;
+
 -- Row-level security policies
 -- Ensure tenants can only access their own data
 
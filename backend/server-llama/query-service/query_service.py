@@ -1,17 +1,28 @@
 import os
-from typing import List, Dict, Any, Optional, Union
+from typing import List, Dict, Any, Optional, Union, Set, Tuple, Callable, Awaitable
 import uuid
 import time
-import json
+import asyncio
+import hashlib
+import hmac
 import logging
-from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, Request, Query
+from collections import defaultdict
+from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, Request, Query, Response, Header
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
 import httpx
-from supabase import create_client, Client
-import redis
-from redis.exceptions import ConnectionError
-from tenacity import retry, stop_after_attempt, wait_exponential
+import orjson
+import asyncpg
+import numpy as np
+import tiktoken
+from supabase import acreate_client, AsyncClient
+import redis.asyncio as aioredis
+from redis.exceptions import ConnectionError, ResponseError
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception
+from cachetools import TTLCache
 
 # LlamaIndex imports
 from llama_index.core import (
@@ -28,7 +39,7 @@ from llama_index.llms.openai import OpenAI
 from llama_index.core.response_synthesizers import ResponseSynthesizer
 from llama_index.core.query_engine import RetrieverQueryEngine
 from llama_index.core.postprocessor import SimilarityPostprocessor
-from llama_index.core.schema import NodeWithScore
+from llama_index.core.schema import NodeWithScore, QueryBundle
 from llama_index.core.callbacks import CallbackManager, LlamaDebugHandler
 
 # Configure logging
@@ -39,7 +50,7 @@ logging.basicConfig(
 logger = logging.getLogger("query-service")
 
 # FastAPI app
-app = FastAPI(title="Linktree AI - Query Service")
+app = FastAPI(title="Linktree AI - Query Service", default_response_class=ORJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -50,28 +61,149 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress JSON bodies; answers and retrieved source texts are mostly prose
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+
 # Configuration
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
+DATABASE_URL = os.environ.get("DATABASE_URL")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "20"))
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", "256"))
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379")
 DEFAULT_EMBEDDING_MODEL = os.environ.get("DEFAULT_EMBEDDING_MODEL", "text-embedding-3-small")
 DEFAULT_LLM_MODEL = os.environ.get("DEFAULT_LLM_MODEL", "gpt-3.5-turbo")
 EMBEDDINGS_SERVICE_URL = os.environ.get("EMBEDDINGS_SERVICE_URL", "http://embeddings-service:8001")
+TENANT_CACHE_TTL = int(os.environ.get("TENANT_CACHE_TTL", "60"))
+EMBEDDING_DIMENSION = int(os.environ.get("EMBEDDING_DIMENSION", "1536"))
+SEMANTIC_CACHE_TTL = int(os.environ.get("SEMANTIC_CACHE_TTL", "900"))
+SEMANTIC_CACHE_MAX_DISTANCE = float(os.environ.get("SEMANTIC_CACHE_MAX_DISTANCE", "0.05"))
+SEMANTIC_CACHE_VECTOR_TYPE = os.environ.get("SEMANTIC_CACHE_VECTOR_TYPE", "INT8")
+SIMILARITY_CUTOFF = float(os.environ.get("SIMILARITY_CUTOFF", "0.7"))
+QUERY_ENGINE_CACHE_SIZE = int(os.environ.get("QUERY_ENGINE_CACHE_SIZE", "1024"))
+QUERY_ENGINE_CACHE_TTL = int(os.environ.get("QUERY_ENGINE_CACHE_TTL", "300"))
+EMBED_BATCH_WINDOW_MS = int(os.environ.get("EMBED_BATCH_WINDOW_MS", "10"))
+EMBED_BATCH_MAX_SIZE = int(os.environ.get("EMBED_BATCH_MAX_SIZE", "64"))
+QUERY_BATCH_MAX_SIZE = int(os.environ.get("QUERY_BATCH_MAX_SIZE", "10"))
+TOKEN_USAGE_FLUSH_INTERVAL = float(os.environ.get("TOKEN_USAGE_FLUSH_INTERVAL", "5.0"))
+TOKEN_USAGE_FLUSH_EVENTS = int(os.environ.get("TOKEN_USAGE_FLUSH_EVENTS", "1000"))
+LOCAL_CACHE_SIZE = int(os.environ.get("LOCAL_CACHE_SIZE", "10000"))
+LOCAL_CACHE_TTL = int(os.environ.get("LOCAL_CACHE_TTL", "30"))
+TENANT_INVALIDATION_CHANNEL = "tenant:invalidate"
+
+if SEMANTIC_CACHE_VECTOR_TYPE not in ("INT8", "FLOAT32"):
+    raise ValueError(f"Unsupported SEMANTIC_CACHE_VECTOR_TYPE: {SEMANTIC_CACHE_VECTOR_TYPE}")
+
+# LLM catalog, the models each subscription tier may use and its default model
+LLM_MODELS = {
+    "gpt-3.5-turbo": {
+        "id": "gpt-3.5-turbo",
+        "name": "GPT-3.5 Turbo",
+        "provider": "openai",
+        "description": "Fast and cost-effective model for most queries"
+    },
+    "gpt-4-turbo": {
+        "id": "gpt-4-turbo",
+        "name": "GPT-4 Turbo",
+        "provider": "openai",
+        "description": "Advanced reasoning capabilities for complex queries"
+    },
+    "gpt-4-turbo-vision": {
+        "id": "gpt-4-turbo-vision",
+        "name": "GPT-4 Turbo Vision",
+        "provider": "openai",
+        "description": "Vision capabilities for image analysis (if needed)"
+    },
+    "claude-3-5-sonnet": {
+        "id": "claude-3-5-sonnet",
+        "name": "Claude 3.5 Sonnet",
+        "provider": "anthropic",
+        "description": "Alternative model with excellent instruction following"
+    }
+}
+
+TIER_LLM_MODELS = {
+    "free": ("gpt-3.5-turbo",),
+    "pro": ("gpt-3.5-turbo", "gpt-4-turbo"),
+    "business": ("gpt-3.5-turbo", "gpt-4-turbo", "gpt-4-turbo-vision", "claude-3-5-sonnet")
+}
+
+TIER_DEFAULT_LLM_MODELS = {
+    "free": "gpt-3.5-turbo",
+    "pro": "gpt-4-turbo",
+    "business": "gpt-4-turbo"
+}
+
+# Billed tokens per model token
+LLM_COST_FACTORS = {
+    "gpt-3.5-turbo": 1.0,
+    "gpt-4-turbo": 5.0,
+    "gpt-4-turbo-vision": 10.0,
+    "claude-3-5-sonnet": 8.0
+}
+
+# /llm/models bodies, serialized once per tier
+LLM_MODELS_RESPONSES = {
+    tier: orjson.dumps({"models": [LLM_MODELS[model] for model in models]})
+    for tier, models in TIER_LLM_MODELS.items()
+}
+EMPTY_LLM_MODELS_RESPONSE = orjson.dumps({"models": []})
+
+# Redis Search index over cached query responses; the vector type is appended to both
+# so switching it never mixes encodings in one index
+SEMANTIC_CACHE_INDEX = "idx:qcache"
+SEMANTIC_CACHE_PREFIX = "qcache"
 
 # Redis connection for caching
 try:
-    redis_client = redis.from_url(REDIS_URL)
+    redis_client = aioredis.from_url(REDIS_URL)
     print("Redis connected successfully")
 except ConnectionError:
     print("Warning: Redis connection failed. Running without cache.")
     redis_client = None
 
-# Supabase client
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Supabase client, created on startup since the async client is built in a coroutine
+supabase: Optional[AsyncClient] = None
 
-# Initialize HTTP client for embedding service
-http_client = httpx.AsyncClient(timeout=30.0)
+# Direct Postgres pool for the hot read paths; asyncpg keeps each query prepared per
+# connection. None keeps everything on PostgREST
+db_pool: Optional[asyncpg.Pool] = None
+
+# Shared keep-alive HTTP/2 client for the embedding service. The transport retries
+# failed connection attempts; request-level retries are in post_embeddings
+http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(30.0, connect=2.0),
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100)
+    )
+)
+
+# One tiktoken encoder per model, built on first use
+token_encodings: Dict[str, tiktoken.Encoding] = {}
+
+# Set on startup once the semantic cache index exists; Redis without the search module
+# leaves it off. INT8 vectors need Redis 8, older servers fall back to FLOAT32
+semantic_cache_enabled = False
+semantic_cache_vector_type = SEMANTIC_CACHE_VECTOR_TYPE
+semantic_cache_index = f"{SEMANTIC_CACHE_INDEX}:{SEMANTIC_CACHE_VECTOR_TYPE.lower()}"
+semantic_cache_prefix = f"{SEMANTIC_CACHE_PREFIX}:{SEMANTIC_CACHE_VECTOR_TYPE.lower()}:"
+
+# Query engines keyed by (tenant, collection, model, top_k, response mode). Building one
+# is synchronous, so there's no await between the lookup and the insert to guard
+query_engine_cache: TTLCache = TTLCache(maxsize=QUERY_ENGINE_CACHE_SIZE, ttl=QUERY_ENGINE_CACHE_TTL)
+
+# In-process first tier in front of Redis for the hottest tenants and queries. Entries live
+# at most LOCAL_CACHE_TTL seconds; tenant entries are also dropped on invalidation messages
+local_tenant_cache: TTLCache = TTLCache(maxsize=LOCAL_CACHE_SIZE, ttl=LOCAL_CACHE_TTL)
+local_semantic_cache: TTLCache = TTLCache(maxsize=LOCAL_CACHE_SIZE, ttl=LOCAL_CACHE_TTL)
+tenant_invalidation_task: Optional[asyncio.Task] = None
+
+# Drops retrieved nodes below the cutoff. The scores are the cosine similarities pgvector
+# already computed, so this is a comparison per node; it holds no state and is shared
+similarity_postprocessor = SimilarityPostprocessor(similarity_cutoff=SIMILARITY_CUTOFF)
 
 # Debug handler for LlamaIndex
 llama_debug = LlamaDebugHandler(print_trace_on_end=False)
@@ -93,11 +225,15 @@ class QueryRequest(BaseModel):
     stream: Optional[bool] = False
 
 class QueryContextItem(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+    
     text: str
     metadata: Optional[Dict[str, Any]] = None
     score: Optional[float] = None
 
 class QueryResponse(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+    
     tenant_id: str
     query: str
     response: str
@@ -106,6 +242,24 @@ class QueryResponse(BaseModel):
     llm_model: str
     collection_name: str
 
+class QueryBatchRequest(BaseModel):
+    tenant_id: str
+    queries: List[QueryRequest] = Field(min_length=1, max_length=QUERY_BATCH_MAX_SIZE)
+
+class QueryBatchItem(BaseModel):
+    """Either the query's response or the status and detail of its error"""
+    result: Optional[QueryResponse] = None
+    status_code: int = 200
+    error: Optional[str] = None
+
+class QueryBatchResponse(BaseModel):
+    tenant_id: str
+    results: List[QueryBatchItem]
+    processing_time: float
+
+# Validates a whole list of retrieved sources in one call
+SOURCES_ADAPTER = TypeAdapter(List[QueryContextItem])
+
 class HealthcheckResponse(BaseModel):
     status: str
     components: Dict[str, str]
@@ -125,33 +279,148 @@ class DocumentsListResponse(BaseModel):
     offset: int
     collection_name: Optional[str]
 
+@app.on_event("startup")
+async def connect_supabase():
+    global supabase
+    supabase = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+
+@app.on_event("startup")
+async def connect_database():
+    global db_pool
+    if not DATABASE_URL:
+        return
+    try:
+        db_pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=1,
+            max_size=DB_POOL_SIZE,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE
+        )
+    except Exception as e:
+        print(f"Warning: database connection failed, using PostgREST only: {str(e)}")
+        db_pool = None
+
+@app.on_event("shutdown")
+async def close_database():
+    if db_pool:
+        await db_pool.close()
+
+# Read-through two-tier cache for tenant metadata: in-process, then Redis, then fetch_fn.
+# Falls back to fetch_fn when Redis is unavailable
+async def _cached(key: str, ttl: int, fetch_fn: Callable[[], Awaitable[Any]]) -> Any:
+    result = local_tenant_cache.get(key)
+    if result is not None:
+        return result
+    
+    if redis_client:
+        try:
+            cached = await redis_client.get(key)
+            if cached is not None:
+                result = orjson.loads(cached)
+                local_tenant_cache[key] = result
+                return result
+        except Exception as e:
+            logger.warning(f"Error reading cache key {key}: {str(e)}")
+    
+    result = await fetch_fn()
+    local_tenant_cache[key] = result
+    
+    if redis_client:
+        try:
+            await redis_client.setex(key, ttl, orjson.dumps(result))
+        except Exception as e:
+            logger.warning(f"Error writing cache key {key}: {str(e)}")
+    
+    return result
+
+# Drop tenant entries from this replica's local cache when any replica invalidates them
+async def listen_tenant_invalidations():
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            await pubsub.subscribe(TENANT_INVALIDATION_CHANNEL)
+            async for message in pubsub.listen():
+                local_tenant_cache.pop(f"tenant:{message['data'].decode()}", None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Tenant invalidation listener failed, resubscribing: {str(e)}")
+            # Entries could have been missed while disconnected
+            local_tenant_cache.clear()
+            await asyncio.sleep(1)
+
+@app.on_event("startup")
+async def start_tenant_invalidation_listener():
+    global tenant_invalidation_task
+    if redis_client:
+        tenant_invalidation_task = asyncio.create_task(listen_tenant_invalidations())
+
+@app.on_event("shutdown")
+async def stop_tenant_invalidation_listener():
+    if tenant_invalidation_task:
+        tenant_invalidation_task.cancel()
+
+# Dependency for internal endpoints: the caller must present the Supabase service key
+# as a bearer token
+async def verify_service_key(authorization: Optional[str] = Header(None)):
+    scheme, _, token = (authorization or "").partition(" ")
+    if not SUPABASE_KEY or scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), SUPABASE_KEY.encode()):
+        raise HTTPException(status_code=401, detail="Invalid service key")
+
 # Dependency to verify tenant exists and subscription is active
 async def verify_tenant(tenant_id: str) -> TenantInfo:
-    tenant_data = supabase.table("tenants").select("*").eq("tenant_id", tenant_id).execute()
+    tier = await _cached(
+        f"tenant:{tenant_id}",
+        TENANT_CACHE_TTL,
+        lambda: fetch_subscription_tier(tenant_id)
+    )
+    
+    return TenantInfo(tenant_id=tenant_id, subscription_tier=tier)
+
+async def fetch_subscription_tier(tenant_id: str) -> str:
+    if db_pool:
+        # One prepared join over the direct pool; no row means an unknown tenant and a
+        # NULL tier means no active subscription
+        row = await db_pool.fetchrow(
+            "SELECT s.subscription_tier FROM tenants t "
+            "LEFT JOIN tenant_subscriptions s ON s.tenant_id = t.tenant_id AND s.is_active "
+            "WHERE t.tenant_id = $1 LIMIT 1",
+            tenant_id
+        )
+        if row is None:
+            raise HTTPException(status_code=404, detail=f"Tenant {tenant_id} not found")
+        if row["subscription_tier"] is None:
+            raise HTTPException(status_code=403, detail=f"No active subscription for tenant {tenant_id}")
+        return row["subscription_tier"]
+    
+    # Tenant and active subscription lookups are independent, so run them together
+    tenant_data, subscription_data = await asyncio.gather(
+        supabase.table("tenants").select("*").eq("tenant_id", tenant_id).execute(),
+        supabase.table("tenant_subscriptions").select("*") \
+            .eq("tenant_id", tenant_id) \
+            .eq("is_active", True) \
+            .execute()
+    )
     
     if not tenant_data.data:
         raise HTTPException(status_code=404, detail=f"Tenant {tenant_id} not found")
     
-    # Check if subscription is active
-    subscription_data = supabase.table("tenant_subscriptions").select("*") \
-        .eq("tenant_id", tenant_id) \
-        .eq("is_active", True) \
-        .execute()
-    
     if not subscription_data.data:
         raise HTTPException(status_code=403, detail=f"No active subscription for tenant {tenant_id}")
     
-    return TenantInfo(
-        tenant_id=tenant_id,
-        subscription_tier=subscription_data.data[0]["subscription_tier"]
-    )
+    return subscription_data.data[0]["subscription_tier"]
 
 # Check tenant quotas
 async def check_tenant_quotas(tenant_info: TenantInfo) -> bool:
-    # Get tenant's current usage
-    usage_data = supabase.table("tenant_stats").select("*") \
-        .eq("tenant_id", tenant_info.tenant_id) \
-        .execute()
+    # Get tenant's current usage and the limits for their tier together
+    usage_data, tier_limits = await asyncio.gather(
+        supabase.table("tenant_stats").select("*") \
+            .eq("tenant_id", tenant_info.tenant_id) \
+            .execute(),
+        supabase.table("tenant_features").select("*") \
+            .eq("tier", tenant_info.subscription_tier) \
+            .execute()
+    )
     
     if not usage_data.data:
         # No usage data yet, they're under quota
@@ -159,11 +428,6 @@ async def check_tenant_quotas(tenant_info: TenantInfo) -> bool:
     
     current_usage = usage_data.data[0]
     
-    # Get limits based on subscription tier
-    tier_limits = supabase.table("tenant_features").select("*") \
-        .eq("tier", tenant_info.subscription_tier) \
-        .execute()
-    
     if not tier_limits.data:
         raise HTTPException(status_code=500, detail="Subscription tier limits not found")
     
@@ -175,22 +439,275 @@ async def check_tenant_quotas(tenant_info: TenantInfo) -> bool:
     
     return True
 
-# Generate embeddings through the embeddings service
-async def generate_embedding(text: str, tenant_id: str) -> List[float]:
+async def ensure_semantic_cache_index(vector_type: str):
+    index = f"{SEMANTIC_CACHE_INDEX}:{vector_type.lower()}"
+    try:
+        await redis_client.execute_command("FT.INFO", index)
+    except ResponseError:
+        await redis_client.execute_command(
+            "FT.CREATE", index,
+            "ON", "HASH",
+            "PREFIX", "1", f"{SEMANTIC_CACHE_PREFIX}:{vector_type.lower()}:",
+            "SCHEMA",
+            "scope", "TAG",
+            "embedding", "VECTOR", "HNSW", "6",
+            "TYPE", vector_type,
+            "DIM", str(EMBEDDING_DIMENSION),
+            "DISTANCE_METRIC", "COSINE"
+        )
+
+@app.on_event("startup")
+async def create_semantic_cache_index():
+    """Create the HNSW index for the semantic query cache if it doesn't exist yet"""
+    global semantic_cache_enabled, semantic_cache_vector_type, semantic_cache_index, semantic_cache_prefix
+    if not redis_client:
+        return
+    
+    vector_types = [SEMANTIC_CACHE_VECTOR_TYPE]
+    if SEMANTIC_CACHE_VECTOR_TYPE != "FLOAT32":
+        vector_types.append("FLOAT32")
+    
+    for vector_type in vector_types:
+        try:
+            await ensure_semantic_cache_index(vector_type)
+        except Exception as e:
+            logger.warning(f"Semantic cache index with {vector_type} vectors unavailable: {str(e)}")
+            continue
+        
+        semantic_cache_enabled = True
+        semantic_cache_vector_type = vector_type
+        semantic_cache_index = f"{SEMANTIC_CACHE_INDEX}:{vector_type.lower()}"
+        semantic_cache_prefix = f"{SEMANTIC_CACHE_PREFIX}:{vector_type.lower()}:"
+        return
+    
+    logger.warning("Semantic cache disabled")
+
+# Encode a query embedding for the cache index. Cosine distance ignores scale, so int8
+# vectors are scaled to the full [-127, 127] range and the scale itself isn't kept
+def encode_cache_vector(embedding: List[float]) -> bytes:
+    vector = np.asarray(embedding, dtype=np.float32)
+    if semantic_cache_vector_type == "INT8":
+        scale = float(np.max(np.abs(vector))) or 1.0
+        return np.round(vector * (127 / scale)).astype(np.int8).tobytes()
+    return vector.tobytes()
+
+# Everything that changes the answer besides the query text, hashed into a TAG value so
+# cached responses are only reused within the same tenant, collection and settings
+def semantic_cache_scope(
+    tenant_id: str,
+    collection_name: str,
+    llm_model: str,
+    similarity_top_k: int,
+    response_mode: str
+) -> str:
+    return hashlib.sha1(
+        f"{tenant_id}|{collection_name}|{llm_model}|{similarity_top_k}|{response_mode}".encode()
+    ).hexdigest()
+
+async def get_cached_response(scope: str, query_vector: bytes) -> Optional[QueryResponse]:
+    """Return the cached response of the nearest earlier query in scope, if close enough"""
+    # Repeats of the same query embed to the same vector, so hot queries hit in-process
+    local_key = (scope, query_vector)
+    cached_response = local_semantic_cache.get(local_key)
+    if cached_response is not None:
+        return cached_response
+    
+    try:
+        result = await redis_client.execute_command(
+            "FT.SEARCH", semantic_cache_index,
+            f"(@scope:{{{scope}}})=>[KNN 1 @embedding $vec AS score]",
+            "PARAMS", "2", "vec", query_vector,
+            "RETURN", "2", "score", "resp",
+            "DIALECT", "2"
+        )
+    except Exception as e:
+        logger.warning(f"Semantic cache lookup failed: {str(e)}")
+        return None
+    
+    if not result or result[0] == 0:
+        return None
+    
+    fields = dict(zip(result[2][::2], result[2][1::2]))
+    if float(fields[b"score"]) > SEMANTIC_CACHE_MAX_DISTANCE:
+        return None
+    
+    cached_response = QueryResponse.model_validate_json(fields[b"resp"])
+    local_semantic_cache[local_key] = cached_response
+    return cached_response
+
+async def cache_response(scope: str, query: str, query_vector: bytes, response: QueryResponse):
+    """Store a response in the semantic cache under its query embedding"""
+    key = semantic_cache_prefix + hashlib.sha1(f"{scope}|{query}".encode()).hexdigest()
+    local_semantic_cache[(scope, query_vector)] = response
+    
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hset(key, mapping={
+            "scope": scope,
+            "embedding": query_vector,
+            "resp": response.model_dump_json()
+        })
+        pipe.expire(key, SEMANTIC_CACHE_TTL)
+        await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Semantic cache write failed: {str(e)}")
+
+# Embed the query once up front: it keys the semantic cache and is handed to the
+# retriever. Returns None when the cache is off or the embeddings service fails, in
+# which case the query engine embeds the query itself
+async def embed_query_for_cache(query: str, tenant_id: str) -> Optional[List[float]]:
+    if not semantic_cache_enabled:
+        return None
+    
+    try:
+        return await generate_embedding(query, tenant_id)
+    except HTTPException:
+        return None
+
+# Timeouts, dropped connections and 5xx responses are worth retrying; 4xx are not
+def is_retryable_error(error: BaseException) -> bool:
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+# POST texts to the embeddings service in one request
+@retry(
+    retry=retry_if_exception(is_retryable_error),
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=0.1, max=1.0),
+    reraise=True
+)
+async def post_embeddings(texts: List[str], tenant_id: str) -> List[List[float]]:
     payload = {
         "tenant_id": tenant_id,
-        "texts": [text]
+        "texts": texts
     }
     
-    try:
-        response = await http_client.post(f"{EMBEDDINGS_SERVICE_URL}/embed", json=payload)
-        response.raise_for_status()
-        result = response.json()
+    response = await http_client.post(
+        f"{EMBEDDINGS_SERVICE_URL}/embed",
+        content=orjson.dumps(payload),
+        headers={"Content-Type": "application/json"}
+    )
+    response.raise_for_status()
+    result = orjson.loads(response.content)
+    
+    if not result.get("embeddings") or len(result["embeddings"]) != len(texts):
+        raise ValueError("No embeddings returned from service")
+    
+    return result["embeddings"]
+
+class EmbeddingRequestBatcher:
+    """Coalesces concurrent single-text embedding calls into one /embed POST per tenant."""
+    
+    def __init__(
+        self,
+        window_ms: int = EMBED_BATCH_WINDOW_MS,
+        max_batch_size: int = EMBED_BATCH_MAX_SIZE,
+    ):
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flushes: Set[asyncio.Task] = set()
+    
+    def start(self) -> None:
+        """Start the background drainer on the running event loop."""
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self) -> None:
+        """Stop draining and wait for requests already sent."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
         
-        if result.get("embeddings") and len(result["embeddings"]) > 0:
-            return result["embeddings"][0]
-        else:
-            raise ValueError("No embedding returned from service")
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+    
+    async def embed(self, text: str, tenant_id: str) -> List[float]:
+        """Embed one text, sharing the POST with other calls for the tenant in the same window."""
+        # Outside the app lifecycle there is nothing draining the queue
+        if self._task is None:
+            return (await post_embeddings([text], tenant_id))[0]
+        
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((tenant_id, text, future))
+        return await future
+    
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            
+            # Keep collecting until the window closes or the batch is full
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            flush = asyncio.create_task(self._flush(batch))
+            self._flushes.add(flush)
+            flush.add_done_callback(self._flushes.discard)
+    
+    async def _flush(self, batch: List[Tuple[str, str, asyncio.Future]]) -> None:
+        by_tenant: Dict[str, List[Tuple[str, asyncio.Future]]] = {}
+        for tenant_id, text, future in batch:
+            by_tenant.setdefault(tenant_id, []).append((text, future))
+        
+        await asyncio.gather(*[
+            self._flush_tenant(tenant_id, items)
+            for tenant_id, items in by_tenant.items()
+        ])
+    
+    async def _flush_tenant(self, tenant_id: str, items: List[Tuple[str, asyncio.Future]]) -> None:
+        try:
+            results = await post_embeddings([text for text, _ in items], tenant_id)
+        except Exception as e:
+            if len(items) == 1:
+                results = [e]
+            else:
+                # Retry each text on its own so one bad text only fails its own caller
+                results = await asyncio.gather(
+                    *[self._embed_one(text, tenant_id) for text, _ in items],
+                    return_exceptions=True
+                )
+        
+        for (_, future), result in zip(items, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+    
+    @staticmethod
+    async def _embed_one(text: str, tenant_id: str) -> List[float]:
+        return (await post_embeddings([text], tenant_id))[0]
+
+embedding_batcher = EmbeddingRequestBatcher()
+
+@app.on_event("startup")
+async def start_embedding_batcher():
+    embedding_batcher.start()
+
+@app.on_event("shutdown")
+async def stop_embedding_batcher():
+    await embedding_batcher.stop()
+    await http_client.aclose()
+
+# Generate embeddings through the embeddings service
+async def generate_embedding(text: str, tenant_id: str) -> List[float]:
+    try:
+        return await embedding_batcher.embed(text, tenant_id)
     except Exception as e:
         logger.error(f"Error getting embedding: {str(e)}")
         raise HTTPException(
@@ -212,27 +729,24 @@ class EmbeddingServiceProvider(OpenAIEmbedding):
         return await generate_embedding(text, self.tenant_id)
     
     async def _aget_text_embedding_batch(self, texts: List[str]) -> List[List[float]]:
-        payload = {
-            "tenant_id": self.tenant_id,
-            "texts": texts
-        }
-        
         try:
-            response = await http_client.post(f"{EMBEDDINGS_SERVICE_URL}/embed", json=payload)
-            response.raise_for_status()
-            result = response.json()
-            
-            if result.get("embeddings"):
-                return result["embeddings"]
-            else:
-                raise ValueError("No embeddings returned from service")
+            return await post_embeddings(texts, self.tenant_id)
         except Exception as e:
             logger.error(f"Error getting batch embeddings: {str(e)}")
-            # Fallback to individual requests
-            results = []
-            for text in texts:
-                results.append(await self._aget_text_embedding(text))
-            return results
+            # Fall back to one request per text, sent concurrently and bypassing the
+            # batcher; the caller needs every vector, so any text that still fails
+            # fails the batch
+            return await asyncio.gather(*[self._aget_single_embedding(text) for text in texts])
+    
+    async def _aget_single_embedding(self, text: str) -> List[float]:
+        try:
+            return (await post_embeddings([text], self.tenant_id))[0]
+        except Exception as e:
+            logger.error(f"Error getting embedding: {str(e)}")
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error getting embedding: {str(e)}"
+            )
 
 # Get vector store for a tenant
 def get_tenant_vector_store(tenant_id: str, collection_name: Optional[str] = None) -> SupabaseVectorStore:
@@ -253,36 +767,25 @@ def get_tenant_vector_store(tenant_id: str, collection_name: Optional[str] = Non
     
     return vector_store
 
-# Create LLM based on tenant tier
-def get_llm_for_tenant(tenant_info: TenantInfo, requested_model: Optional[str] = None) -> OpenAI:
-    """Get appropriate LLM based on tenant subscription tier"""
-    
-    # Map subscription tiers to allowed models
-    tier_models = {
-        "free": ["gpt-3.5-turbo"],
-        "pro": ["gpt-3.5-turbo", "gpt-4-turbo"],
-        "business": ["gpt-3.5-turbo", "gpt-4-turbo", "gpt-4-turbo-vision", "claude-3-5-sonnet"]
-    }
-    
-    # Default model based on tier
-    default_models = {
-        "free": "gpt-3.5-turbo",
-        "pro": "gpt-4-turbo",
-        "business": "gpt-4-turbo"
-    }
+# Pick the LLM model name for a tenant
+def resolve_llm_model(tenant_info: TenantInfo, requested_model: Optional[str] = None) -> str:
+    """Get the model to use based on tenant subscription tier"""
     
     # Get allowed models for tenant tier
-    allowed_models = tier_models.get(tenant_info.subscription_tier, ["gpt-3.5-turbo"])
+    allowed_models = TIER_LLM_MODELS.get(tenant_info.subscription_tier, ("gpt-3.5-turbo",))
     
     # Use requested model if specified and allowed, otherwise use default
-    model_name = None
     if requested_model and requested_model in allowed_models:
-        model_name = requested_model
-    else:
-        model_name = default_models.get(tenant_info.subscription_tier, "gpt-3.5-turbo")
+        return requested_model
+    
+    return TIER_DEFAULT_LLM_MODELS.get(tenant_info.subscription_tier, "gpt-3.5-turbo")
+
+# Create LLM based on tenant tier
+def get_llm_for_tenant(tenant_info: TenantInfo, requested_model: Optional[str] = None) -> OpenAI:
+    """Get appropriate LLM based on tenant subscription tier"""
     
     return OpenAI(
-        model=model_name,
+        model=resolve_llm_model(tenant_info, requested_model),
         temperature=0.1,
         api_key=OPENAI_API_KEY
     )
@@ -293,10 +796,24 @@ async def create_query_engine(
     collection_name: str,
     llm_model: Optional[str] = None,
     similarity_top_k: int = 4,
-    response_mode: str = "compact"
+    response_mode: str = "compact",
+    streaming: bool = False
 ) -> RetrieverQueryEngine:
     """Create a query engine for retrieving and generating responses"""
     
+    # Engines hold no per-query state, so reuse one built for the same settings
+    cache_key = (
+        tenant_info.tenant_id,
+        collection_name,
+        resolve_llm_model(tenant_info, llm_model),
+        similarity_top_k,
+        response_mode,
+        streaming
+    )
+    query_engine = query_engine_cache.get(cache_key)
+    if query_engine is not None:
+        return query_engine
+    
     # Get the vector store
     vector_store = get_tenant_vector_store(tenant_info.tenant_id, collection_name)
     
@@ -316,126 +833,292 @@ async def create_query_engine(
     response_synthesizer = ResponseSynthesizer.from_args(
         response_mode=response_mode,
         llm=llm,
-        callback_manager=callback_manager
+        callback_manager=callback_manager,
+        streaming=streaming
     )
     
     # Create the query engine
     query_engine = RetrieverQueryEngine(
         retriever=retriever,
         response_synthesizer=response_synthesizer,
-        node_postprocessors=[
-            SimilarityPostprocessor(similarity_cutoff=0.7)
-        ]
+        node_postprocessors=[similarity_postprocessor]
     )
     
+    query_engine_cache[cache_key] = query_engine
     return query_engine
 
-# Track token usage
-async def track_token_usage(tenant_id: str, estimated_tokens: int, model: str):
+def get_token_encoding(model: str) -> tiktoken.Encoding:
+    encoding = token_encodings.get(model)
+    if encoding is None:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            # Non-OpenAI models have no tiktoken mapping; cl100k_base is a close estimate
+            encoding = tiktoken.get_encoding("cl100k_base")
+        token_encodings[model] = encoding
+    return encoding
+
+def count_tokens(texts: List[str], model: str) -> int:
+    # The Rust tokenizer encodes the batch in parallel outside the GIL
+    return sum(
+        len(ids) for ids in get_token_encoding(model).encode_ordinary_batch(texts, num_threads=8)
+    )
+
+# Record approximate token usage for the tenant
+async def increment_token_usage(tenant_id: str, tokens: int):
+    await supabase.rpc(
+        "increment_token_usage",
+        {
+            "p_tenant_id": tenant_id,
+            "p_tokens": tokens
+        }
+    ).execute()
+
+# Token usage is buffered per tenant, already weighted by model cost, and flushed in the
+# background every TOKEN_USAGE_FLUSH_INTERVAL seconds or TOKEN_USAGE_FLUSH_EVENTS queries
+pending_token_usage: Dict[str, int] = defaultdict(int)
+pending_token_events = 0
+token_usage_flush_requested = asyncio.Event()
+
+def track_token_usage(tenant_id: str, estimated_tokens: int, model: str):
     """Track token usage for billing and quotas"""
+    global pending_token_events
+    
+    # Adjust cost factor based on model
+    cost_factor = LLM_COST_FACTORS.get(model, 1.0)
+    pending_token_usage[tenant_id] += int(estimated_tokens * cost_factor)
     
+    pending_token_events += 1
+    if pending_token_events >= TOKEN_USAGE_FLUSH_EVENTS:
+        token_usage_flush_requested.set()
+
+async def flush_token_usage():
+    global pending_token_usage, pending_token_events
+    if not pending_token_usage:
+        return
+    
+    usage, pending_token_usage = pending_token_usage, defaultdict(int)
+    pending_token_events = 0
+    results = await asyncio.gather(
+        *(increment_token_usage(tenant_id, tokens) for tenant_id, tokens in usage.items()),
+        return_exceptions=True
+    )
+    
+    # Keep failed increments for the next flush
+    for (tenant_id, tokens), result in zip(usage.items(), results):
+        if isinstance(result, Exception):
+            logger.error(f"Error tracking token usage for tenant {tenant_id}: {str(result)}")
+            pending_token_usage[tenant_id] += tokens
+
+async def token_usage_flusher():
+    while True:
+        try:
+            await asyncio.wait_for(token_usage_flush_requested.wait(), TOKEN_USAGE_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        token_usage_flush_requested.clear()
+        await flush_token_usage()
+
+@app.on_event("startup")
+async def start_token_usage_flusher():
+    app.state.token_usage_task = asyncio.create_task(token_usage_flusher())
+
+@app.on_event("shutdown")
+async def stop_token_usage_flusher():
+    app.state.token_usage_task.cancel()
     try:
-        # Adjust cost factor based on model
-        model_cost_factor = {
-            "gpt-3.5-turbo": 1.0,
-            "gpt-4-turbo": 5.0,
-            "gpt-4-turbo-vision": 10.0,
-            "claude-3-5-sonnet": 8.0
-        }
+        await app.state.token_usage_task
+    except asyncio.CancelledError:
+        pass
+    await flush_token_usage()
+
+# Log a query for analytics
+async def log_query(record: Dict[str, Any]):
+    try:
+        await supabase.table("query_logs").insert(record).execute()
+    except Exception as e:
+        logger.error(f"Error logging query: {str(e)}")
+
+# Build the query response and schedule usage tracking and the analytics log
+def build_query_response(
+    request: QueryRequest,
+    actual_model: str,
+    answer: str,
+    response: Any,
+    start_time: float,
+    background_tasks: BackgroundTasks
+) -> QueryResponse:
+    # Extract source nodes
+    raw_sources: List[Dict[str, Any]] = []
+    context_texts: List[str] = []
+    for node in getattr(response, "source_nodes", None) or []:
+        text = node.node.text
+        context_texts.append(text)
+        raw_sources.append({
+            "text": text,
+            # Drop tenant-specific metadata that's not relevant to return
+            "metadata": {k: v for k, v in (node.node.metadata or {}).items() if k != "tenant_id"},
+            "score": getattr(node, "score", None)
+        })
+    
+    source_nodes = SOURCES_ADAPTER.validate_python(raw_sources)
+    
+    # Count token usage with the model's BPE encoding
+    qa_tokens = count_tokens([request.query, answer], actual_model)
+    context_tokens = count_tokens(context_texts, actual_model) * 0.5  # Only count fraction as they're embeddings
+    total_tokens = int(qa_tokens + context_tokens)
+    
+    # Usage is buffered for the flusher; the analytics log and the cache write run after
+    # the response is sent
+    track_token_usage(request.tenant_id, total_tokens, actual_model)
+    background_tasks.add_task(log_query, {
+        "tenant_id": request.tenant_id,
+        "query": request.query,
+        "collection": request.collection_name,
+        "llm_model": actual_model,
+        "tokens_estimated": total_tokens,
+        "response_time_ms": int((time.time() - start_time) * 1000)
+    })
+    
+    return QueryResponse(
+        tenant_id=request.tenant_id,
+        query=request.query,
+        response=answer,
+        sources=source_nodes,
+        processing_time=time.time() - start_time,
+        llm_model=actual_model,
+        collection_name=request.collection_name or "default"
+    )
+
+# An explicit encoding keeps GZipMiddleware from buffering events into compressed blocks
+SSE_HEADERS = {"Content-Encoding": "identity", "Cache-Control": "no-cache"}
+
+def sse_event(data: bytes, event: Optional[str] = None) -> bytes:
+    if event:
+        return b"event: " + event.encode() + b"\ndata: " + data + b"\n\n"
+    return b"data: " + data + b"\n\n"
+
+# Server-sent events for a streamed query: one "delta" per token, then "done" with the full response
+async def stream_query_events(
+    response: Any,
+    request: QueryRequest,
+    actual_model: str,
+    start_time: float,
+    background_tasks: BackgroundTasks,
+    cache_target: Optional[Tuple[str, bytes]]
+):
+    deltas: List[str] = []
+    try:
+        if hasattr(response, "async_response_gen"):
+            token_gen = response.async_response_gen()
+        else:
+            # Older synthesizers hand back a blocking generator; pull it off the event loop
+            token_gen = iterate_in_threadpool(response.response_gen)
         
-        cost_factor = model_cost_factor.get(model, 1.0)
-        adjusted_tokens = int(estimated_tokens * cost_factor)
+        async for delta in token_gen:
+            deltas.append(delta)
+            yield sse_event(orjson.dumps({"delta": delta}))
         
-        # Call the token usage tracking function
-        supabase.rpc(
-            "increment_token_usage",
-            {
-                "p_tenant_id": tenant_id,
-                "p_tokens": adjusted_tokens
-            }
-        ).execute()
+        # Tasks added here still run: the response executes its background tasks after the body ends
+        query_response = build_query_response(
+            request, actual_model, "".join(deltas), response, start_time, background_tasks
+        )
+        if cache_target is not None:
+            cache_scope, query_vector = cache_target
+            background_tasks.add_task(cache_response, cache_scope, request.query, query_vector, query_response)
+        
+        yield sse_event(query_response.model_dump_json().encode(), "done")
     except Exception as e:
-        logger.error(f"Error tracking token usage: {str(e)}")
+        logger.error(f"Error streaming query: {str(e)}")
+        yield sse_event(orjson.dumps({"detail": f"Error processing query: {str(e)}"}), "error")
+
+async def cached_query_events(cached_response: QueryResponse):
+    yield sse_event(orjson.dumps({"delta": cached_response.response}))
+    yield sse_event(cached_response.model_dump_json().encode(), "done")
 
 # API endpoints
 @app.post("/query", response_model=QueryResponse)
 async def process_query(
     request: QueryRequest,
+    background_tasks: BackgroundTasks,
     tenant_info: TenantInfo = Depends(verify_tenant)
 ):
     """Process a search query using RAG and return results with sources"""
     
     start_time = time.time()
     
-    # Check quotas
-    await check_tenant_quotas(tenant_info)
+    # Check quotas while the query is embedded
+    _, query_embedding = await asyncio.gather(
+        check_tenant_quotas(tenant_info),
+        embed_query_for_cache(request.query, request.tenant_id)
+    )
     
     try:
+        # Get actual LLM model used
+        actual_model = resolve_llm_model(tenant_info, request.llm_model)
+        
+        if query_embedding is not None:
+            query_vector = encode_cache_vector(query_embedding)
+            cache_scope = semantic_cache_scope(
+                request.tenant_id,
+                request.collection_name,
+                actual_model,
+                request.similarity_top_k or 4,
+                request.response_mode or "compact"
+            )
+            
+            cached_response = await get_cached_response(cache_scope, query_vector)
+            if cached_response is not None:
+                # The hit may come from a differently worded query; echo the caller's own
+                cached_response = cached_response.model_copy(update={
+                    "query": request.query,
+                    "processing_time": time.time() - start_time
+                })
+                if request.stream:
+                    return StreamingResponse(
+                        cached_query_events(cached_response),
+                        media_type="text/event-stream",
+                        headers=SSE_HEADERS
+                    )
+                return cached_response
+        
         # Create query engine
         query_engine = await create_query_engine(
             tenant_info=tenant_info,
             collection_name=request.collection_name,
             llm_model=request.llm_model,
             similarity_top_k=request.similarity_top_k or 4,
-            response_mode=request.response_mode or "compact"
+            response_mode=request.response_mode or "compact",
+            streaming=bool(request.stream)
         )
         
-        # Execute query
-        response = await query_engine.aquery(request.query)
-        
-        # Extract source nodes
-        source_nodes: List[QueryContextItem] = []
-        if hasattr(response, "source_nodes"):
-            for node in response.source_nodes:
-                metadata = node.node.metadata.copy() if node.node.metadata else {}
-                
-                # Remove tenant-specific metadata that's not relevant to return
-                if "tenant_id" in metadata:
-                    del metadata["tenant_id"]
-                
-                source_nodes.append(
-                    QueryContextItem(
-                        text=node.node.text,
-                        metadata=metadata,
-                        score=node.score if hasattr(node, "score") else None
-                    )
-                )
-        
-        # Estimate token usage (very approximate)
-        query_tokens = len(request.query.split()) * 1.3
-        response_tokens = len(str(response).split()) * 1.3
-        context_tokens = sum([len(node.text.split()) for node in source_nodes]) * 0.5  # Only count fraction as they're embeddings
-        total_tokens = int(query_tokens + response_tokens + context_tokens)
+        # Execute query; with streaming the synthesizer returns before generation starts
+        response = await query_engine.aquery(
+            QueryBundle(request.query, embedding=query_embedding)
+        )
         
-        # Get actual LLM model used
-        llm = get_llm_for_tenant(tenant_info, request.llm_model)
-        actual_model = llm.model
+        if request.stream:
+            return StreamingResponse(
+                stream_query_events(
+                    response,
+                    request,
+                    actual_model,
+                    start_time,
+                    background_tasks,
+                    (cache_scope, query_vector) if query_embedding is not None else None
+                ),
+                media_type="text/event-stream",
+                headers=SSE_HEADERS
+            )
         
-        # Track usage
-        await track_token_usage(request.tenant_id, total_tokens, actual_model)
+        query_response = build_query_response(
+            request, actual_model, str(response), response, start_time, background_tasks
+        )
         
-        # Log query for analytics
-        try:
-            supabase.table("query_logs").insert({
-                "tenant_id": request.tenant_id,
-                "query": request.query,
-                "collection": request.collection_name,
-                "llm_model": actual_model,
-                "tokens_estimated": total_tokens,
-                "response_time_ms": int((time.time() - start_time) * 1000)
-            }).execute()
-        except Exception as e:
-            logger.error(f"Error logging query: {str(e)}")
+        if query_embedding is not None:
+            background_tasks.add_task(cache_response, cache_scope, request.query, query_vector, query_response)
         
-        return QueryResponse(
-            tenant_id=request.tenant_id,
-            query=request.query,
-            response=str(response),
-            sources=source_nodes,
-            processing_time=time.time() - start_time,
-            llm_model=actual_model,
-            collection_name=request.collection_name or "default"
-        )
+        return query_response
     
     except Exception as e:
         logger.error(f"Error processing query: {str(e)}")
@@ -444,6 +1127,46 @@ async def process_query(
             detail=f"Error processing query: {str(e)}"
         )
 
+@app.post("/query/batch", response_model=QueryBatchResponse)
+async def process_query_batch(
+    request: QueryBatchRequest,
+    background_tasks: BackgroundTasks,
+    tenant_info: TenantInfo = Depends(verify_tenant)
+):
+    """Process several queries for one tenant in a single request"""
+    
+    # Security check - only allow a tenant to query their own documents
+    if any(query.tenant_id != tenant_info.tenant_id for query in request.queries):
+        raise HTTPException(
+            status_code=403,
+            detail="You can only query your own documents"
+        )
+    
+    start_time = time.time()
+    
+    # Queries run concurrently; their embeddings coalesce in the embedding batcher and
+    # repeated engine settings share one cached query engine. Each query succeeds or
+    # fails on its own, as separate /query calls would
+    outcomes = await asyncio.gather(*(
+        process_query(query.model_copy(update={"stream": False}), background_tasks, tenant_info)
+        for query in request.queries
+    ), return_exceptions=True)
+    
+    results = []
+    for outcome in outcomes:
+        if isinstance(outcome, HTTPException):
+            results.append(QueryBatchItem(status_code=outcome.status_code, error=str(outcome.detail)))
+        elif isinstance(outcome, Exception):
+            results.append(QueryBatchItem(status_code=500, error=f"Error processing query: {str(outcome)}"))
+        else:
+            results.append(QueryBatchItem(result=outcome))
+    
+    return QueryBatchResponse(
+        tenant_id=tenant_info.tenant_id,
+        results=results,
+        processing_time=time.time() - start_time
+    )
+
 @app.get("/documents", response_model=DocumentsListResponse)
 async def list_documents(
     tenant_id: str,
@@ -462,56 +1185,29 @@ async def list_documents(
         )
     
     try:
-        # Query to get unique document IDs and metadata
-        query = supabase.table("document_chunks").select("metadata")
-        
-        # Add filters
-        query = query.eq("tenant_id", tenant_id)
-        if collection_name:
-            query = query.filter("metadata->collection", "eq", collection_name)
-        
-        # Execute query
-        result = query.execute()
-        
-        if not result.data:
-            return DocumentsListResponse(
-                tenant_id=tenant_id,
-                documents=[],
-                total=0,
-                limit=limit,
-                offset=offset,
-                collection_name=collection_name
+        # De-duplicate chunks into documents and paginate in Postgres
+        if db_pool:
+            page = await db_pool.fetchval(
+                "SELECT list_documents($1, $2, $3, $4)",
+                tenant_id, collection_name, limit, offset
             )
-        
-        # Extract unique document IDs and their metadata
-        document_map = {}
-        for chunk in result.data:
-            metadata = chunk["metadata"]
-            if "document_id" in metadata:
-                doc_id = metadata["document_id"]
-                if doc_id not in document_map:
-                    # Extract document metadata
-                    doc_info = {
-                        "document_id": doc_id,
-                        "source": metadata.get("source", "Unknown"),
-                        "author": metadata.get("author"),
-                        "document_type": metadata.get("document_type"),
-                        "collection": metadata.get("collection", "default"),
-                        "created_at": metadata.get("created_at")
-                    }
-                    document_map[doc_id] = doc_info
-        
-        # Convert to list and apply pagination
-        documents = list(document_map.values())
-        total = len(documents)
-        
-        # Simple pagination
-        paginated_documents = documents[offset:offset+limit]
+            page = orjson.loads(page) if page else {}
+        else:
+            result = await supabase.rpc(
+                "list_documents",
+                {
+                    "p_tenant_id": tenant_id,
+                    "p_collection": collection_name,
+                    "p_limit": limit,
+                    "p_offset": offset
+                }
+            ).execute()
+            page = result.data or {}
         
         return DocumentsListResponse(
             tenant_id=tenant_id,
-            documents=paginated_documents,
-            total=total,
+            documents=page.get("documents", []),
+            total=page.get("total", 0),
             limit=limit,
             offset=offset,
             collection_name=collection_name
@@ -539,42 +1235,26 @@ async def list_collections(
         )
     
     try:
-        # Query to get all collections
-        query = supabase.table("document_chunks").select("metadata->collection")
-        
-        # Add tenant filter
-        query = query.eq("tenant_id", tenant_id)
-        
-        # Execute query
-        result = query.execute()
-        
-        if not result.data:
-            return {"collections": []}
-        
-        # Extract unique collection names
-        collections = set()
-        for row in result.data:
-            collection = row.get("collection")
-            if collection:
-                collections.add(collection)
+        # Collections and their document counts, grouped in Postgres
+        if db_pool:
+            rows = await db_pool.fetch(
+                "SELECT collection, document_count FROM list_collections($1)",
+                tenant_id
+            )
+        else:
+            result = await supabase.rpc(
+                "list_collections",
+                {"p_tenant_id": tenant_id}
+            ).execute()
+            rows = result.data or []
         
-        # Get document counts for each collection
-        collection_stats = []
-        for collection in collections:
-            # Count documents in this collection
-            count_query = supabase.table("document_chunks").select("metadata->document_id", "count")
-            count_query = count_query.eq("tenant_id", tenant_id)
-            count_query = count_query.filter("metadata->collection", "eq", collection)
-            count_result = count_query.execute()
-            
-            document_count = 0
-            if count_result.data and count_result.data[0].get("count"):
-                document_count = count_result.data[0]["count"]
-            
-            collection_stats.append({
-                "name": collection,
-                "document_count": document_count
-            })
+        collection_stats = [
+            {
+                "name": row["collection"],
+                "document_count": row["document_count"]
+            }
+            for row in rows
+        ]
         
         return {
             "tenant_id": tenant_id,
@@ -588,29 +1268,37 @@ async def list_collections(
             detail=f"Error listing collections: {str(e)}"
         )
 
+async def probe_supabase() -> str:
+    try:
+        await supabase.table("tenants").select("tenant_id").limit(1).execute()
+        return "available"
+    except Exception:
+        return "unavailable"
+
+async def probe_redis() -> str:
+    try:
+        return "available" if redis_client and await redis_client.ping() else "unavailable"
+    except Exception:
+        return "unavailable"
+
+async def probe_embedding_service() -> str:
+    try:
+        response = await http_client.get(f"{EMBEDDINGS_SERVICE_URL}/status")
+        return "available" if response.status_code == 200 else "degraded"
+    except Exception:
+        return "unavailable"
+
 @app.get("/healthcheck", response_model=HealthcheckResponse)
 async def healthcheck():
     """Check the health of the service and its dependencies"""
     
     try:
-        # Check if Supabase is available
-        supabase_status = "available"
-        try:
-            supabase.table("tenants").select("tenant_id").limit(1).execute()
-        except Exception:
-            supabase_status = "unavailable"
-        
-        # Check if Redis is available
-        redis_status = "available" if redis_client and redis_client.ping() else "unavailable"
-        
-        # Check if embedding service is available
-        embedding_status = "available"
-        try:
-            response = await http_client.get(f"{EMBEDDINGS_SERVICE_URL}/status")
-            if response.status_code != 200:
-                embedding_status = "degraded"
-        except Exception:
-            embedding_status = "unavailable"
+        # Probe all dependencies concurrently so the check takes as long as the slowest one
+        supabase_status, redis_status, embedding_status = await asyncio.gather(
+            probe_supabase(),
+            probe_redis(),
+            probe_embedding_service()
+        )
         
         # Overall status
         overall_status = "healthy"
@@ -644,64 +1332,66 @@ async def list_llm_models(
 ):
     """List available LLM models based on tenant subscription tier"""
     
-    # Map subscription tiers to allowed models
-    tier_models = {
-        "free": [
-            {
-                "id": "gpt-3.5-turbo",
-                "name": "GPT-3.5 Turbo",
-                "provider": "openai",
-                "description": "Fast and cost-effective model for most queries"
-            }
-        ],
-        "pro": [
-            {
-                "id": "gpt-3.5-turbo",
-                "name": "GPT-3.5 Turbo",
-                "provider": "openai",
-                "description": "Fast and cost-effective model for most queries"
-            },
-            {
-                "id": "gpt-4-turbo",
-                "name": "GPT-4 Turbo",
-                "provider": "openai",
-                "description": "Advanced reasoning capabilities for complex queries"
-            }
-        ],
-        "business": [
-            {
-                "id": "gpt-3.5-turbo",
-                "name": "GPT-3.5 Turbo",
-                "provider": "openai",
-                "description": "Fast and cost-effective model for most queries"
-            },
-            {
-                "id": "gpt-4-turbo",
-                "name": "GPT-4 Turbo",
-                "provider": "openai",
-                "description": "Advanced reasoning capabilities for complex queries"
-            },
-            {
-                "id": "gpt-4-turbo-vision",
-                "name": "GPT-4 Turbo Vision",
-                "provider": "openai",
-                "description": "Vision capabilities for image analysis (if needed)"
-            },
-            {
-                "id": "claude-3-5-sonnet",
-                "name": "Claude 3.5 Sonnet",
-                "provider": "anthropic",
-                "description": "Alternative model with excellent instruction following"
-            }
-        ]
-    }
+    return Response(
+        content=LLM_MODELS_RESPONSES.get(tenant_info.subscription_tier, EMPTY_LLM_MODELS_RESPONSE),
+        media_type="application/json"
+    )
+
+# Stats row, last five query logs, active subscription and tier limits for a tenant
+async def fetch_tenant_stats(
+    tenant_id: str,
+    tier: str
+) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]], Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    if db_pool:
+        # The lookups are independent, so each takes its own pooled connection
+        stats, recent_queries, subscription, tier_limits = await asyncio.gather(
+            db_pool.fetchrow(
+                "SELECT document_count, tokens_used, last_activity FROM tenant_stats WHERE tenant_id = $1",
+                tenant_id
+            ),
+            db_pool.fetch(
+                "SELECT query, collection, llm_model, tokens_estimated, created_at FROM ai.query_logs "
+                "WHERE tenant_id = $1 ORDER BY created_at DESC LIMIT 5",
+                tenant_id
+            ),
+            db_pool.fetchrow(
+                "SELECT started_at, expires_at FROM tenant_subscriptions "
+                "WHERE tenant_id = $1 AND is_active LIMIT 1",
+                tenant_id
+            ),
+            db_pool.fetchrow(
+                "SELECT max_tokens_per_month FROM tenant_features WHERE tier = $1",
+                tier
+            )
+        )
+        return (
+            dict(stats) if stats else None,
+            [dict(row) for row in recent_queries],
+            dict(subscription) if subscription else None,
+            dict(tier_limits) if tier_limits else None
+        )
     
-    # Get allowed models for tenant tier
-    available_models = tier_models.get(tenant_info.subscription_tier, [])
+    # Stats, recent query logs, subscription and tier limits are independent lookups
+    stats_query, logs_query, sub_query, tier_query = await asyncio.gather(
+        supabase.table("tenant_stats").select("*").eq("tenant_id", tenant_id).execute(),
+        supabase.table("query_logs").select("*") \
+            .eq("tenant_id", tenant_id) \
+            .order("created_at", desc=True) \
+            .limit(5) \
+            .execute(),
+        supabase.table("tenant_subscriptions").select("*") \
+            .eq("tenant_id", tenant_id) \
+            .eq("is_active", True) \
+            .execute(),
+        supabase.table("tenant_features").select("*").eq("tier", tier).execute()
+    )
     
-    return {
-        "models": available_models
-    }
+    return (
+        stats_query.data[0] if stats_query.data else None,
+        logs_query.data or [],
+        sub_query.data[0] if sub_query.data else None,
+        tier_query.data[0] if tier_query.data else None
+    )
 
 @app.get("/stats")
 async def get_tenant_stats(
@@ -718,10 +1408,11 @@ async def get_tenant_stats(
         )
     
     try:
-        # Get tenant stats
-        stats_query = supabase.table("tenant_stats").select("*").eq("tenant_id", tenant_id).execute()
+        tier = tenant_info.subscription_tier
+        
+        stats, recent_queries, subscription, tier_limits = await fetch_tenant_stats(tenant_id, tier)
         
-        if not stats_query.data:
+        if not stats:
             return {
                 "tenant_id": tenant_id,
                 "document_count": 0,
@@ -729,30 +1420,6 @@ async def get_tenant_stats(
                 "last_activity": None
             }
         
-        stats = stats_query.data[0]
-        
-        # Get query logs for recent activity
-        logs_query = supabase.table("query_logs").select("*") \
-            .eq("tenant_id", tenant_id) \
-            .order("created_at", desc=True) \
-            .limit(5) \
-            .execute()
-        
-        recent_queries = logs_query.data if logs_query.data else []
-        
-        # Get subscription info
-        sub_query = supabase.table("tenant_subscriptions").select("*") \
-            .eq("tenant_id", tenant_id) \
-            .eq("is_active", True) \
-            .execute()
-        
-        subscription = sub_query.data[0] if sub_query.data else None
-        
-        # Get tier limits
-        tier = tenant_info.subscription_tier
-        tier_query = supabase.table("tenant_features").select("*").eq("tier", tier).execute()
-        tier_limits = tier_query.data[0] if tier_query.data else None
-        
         return {
             "tenant_id": tenant_id,
             "document_count": stats.get("document_count", 0),
@@ -782,6 +1449,20 @@ async def get_tenant_stats(
             detail=f"Error getting tenant stats: {str(e)}"
         )
 
+@app.delete("/cache/tenants/{tenant_id}", dependencies=[Depends(verify_service_key)])
+async def invalidate_tenant_cache(tenant_id: str):
+    """Drop cached tenant metadata, called when a subscription changes"""
+    local_tenant_cache.pop(f"tenant:{tenant_id}", None)
+    if redis_client:
+        await redis_client.delete(f"tenant:{tenant_id}")
+        # Other replicas drop their local copies on this message
+        await redis_client.publish(TENANT_INVALIDATION_CHANNEL, tenant_id)
+    
+    return {
+        "success": True,
+        "message": f"Cache invalidated for tenant {tenant_id}"
+    }
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8002)
\ No newline at end of file
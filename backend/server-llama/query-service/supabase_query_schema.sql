@@ -103,6 +103,54 @@ CREATE TABLE IF NOT EXISTS ai.prompt_templates (
 CREATE UNIQUE INDEX IF NOT EXISTS idx_default_prompt_template
 ON ai.prompt_templates(tenant_id) WHERE is_default = true;
 
+-- Index for per-collection lookups on document chunks
+CREATE INDEX IF NOT EXISTS idx_document_chunks_tenant_collection
+ON ai.document_chunks(tenant_id, (metadata->>'collection'));
+
+-- List a tenant's collections with their distinct document counts in one query
+CREATE OR REPLACE FUNCTION list_collections(
+    p_tenant_id UUID
+) RETURNS TABLE (collection TEXT, document_count BIGINT) AS $$
+    SELECT metadata->>'collection' AS collection,
+           COUNT(DISTINCT metadata->>'document_id') AS document_count
+    FROM ai.document_chunks
+    WHERE tenant_id = p_tenant_id
+      AND metadata->>'collection' IS NOT NULL
+    GROUP BY 1
+    ORDER BY 1;
+$$ LANGUAGE sql STABLE;
+
+-- Page through a tenant's documents, one row per document_id, with the total count
+CREATE OR REPLACE FUNCTION list_documents(
+    p_tenant_id UUID,
+    p_collection TEXT DEFAULT NULL,
+    p_limit INTEGER DEFAULT 50,
+    p_offset INTEGER DEFAULT 0
+) RETURNS JSONB AS $$
+    WITH docs AS (
+        SELECT DISTINCT ON (metadata->>'document_id')
+            metadata->>'document_id' AS document_id,
+            COALESCE(metadata->>'source', 'Unknown') AS source,
+            metadata->>'author' AS author,
+            metadata->>'document_type' AS document_type,
+            COALESCE(metadata->>'collection', 'default') AS collection,
+            metadata->>'created_at' AS created_at
+        FROM ai.document_chunks
+        WHERE tenant_id = p_tenant_id
+          AND metadata ? 'document_id'
+          AND (p_collection IS NULL OR metadata->>'collection' = p_collection)
+        ORDER BY metadata->>'document_id'
+    )
+    SELECT jsonb_build_object(
+        'total', (SELECT count(*) FROM docs),
+        'documents', COALESCE(
+            (SELECT jsonb_agg(to_jsonb(page) ORDER BY page.document_id)
+             FROM (SELECT * FROM docs ORDER BY document_id LIMIT p_limit OFFSET p_offset) page),
+            '[]'::jsonb
+        )
+    );
+$$ LANGUAGE sql STABLE;
+
 -- Enable Row-Level Security for query-related tables
 ALTER TABLE ai.query_logs ENABLE ROW LEVEL SECURITY;
 ALTER TABLE ai.saved_responses ENABLE ROW LEVEL SECURITY;
@@ -1,96 +1,262 @@
-import requests
-import json
+import argparse
+import asyncio
+import statistics
+import httpx
+import orjson
 import os
+import socket
+import sys
+from urllib.parse import urlsplit
 from dotenv import load_dotenv
 import time
+import uuid
 
 # Load environment variables
 load_dotenv()
 
 # Configuration
 API_BASE_URL = "http://localhost:8002"
-TENANT_ID = os.getenv("TEST_TENANT_ID", "00000000-0000-0000-0000-000000000000")  # Replace with a real tenant ID
+# Replace with a real tenant ID; parsed here so a malformed ID fails before any request
+TENANT_ID = str(uuid.UUID(os.getenv("TEST_TENANT_ID", "00000000-0000-0000-0000-000000000000")))
 
-def test_basic_query():
-    """Test the /query endpoint with a basic query"""
-    
-    # Prepare query
-    query = "¿Qué es LlamaIndex y cómo funciona RAG?"
-    
-    # Create request payload
-    payload = {
-        "tenant_id": TENANT_ID,
-        "query": query,
-        "collection_name": "default",  # Use your actual collection
-        "similarity_top_k": 4
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+TENANT_PARAMS = {"tenant_id": TENANT_ID}
+
+# Request payloads are fixed, so they are serialized once at import
+BASIC_QUERY = {
+    "tenant_id": TENANT_ID,
+    "query": "¿Qué es LlamaIndex y cómo funciona RAG?",
+    "collection_name": "default",  # Use your actual collection
+    "similarity_top_k": 4
+}
+
+ADVANCED_QUERY = {
+    "tenant_id": TENANT_ID,
+    "query": "Explica las ventajas de un sistema multitenancy para implementaciones RAG",
+    "collection_name": "default",  # Use your actual collection
+    "llm_model": "gpt-4-turbo",  # Might fail if tenant doesn't have access
+    "similarity_top_k": 6,
+    "response_mode": "refine",  # refine mode for longer, more detailed responses
+    "additional_metadata_filter": {
+        "document_type": "technical"  # Filter by document type if applicable
     }
+}
+
+BASIC_QUERY_BODY = orjson.dumps(BASIC_QUERY)
+ADVANCED_QUERY_BODY = orjson.dumps(ADVANCED_QUERY)
+BATCH_QUERY_BODY = orjson.dumps({
+    "tenant_id": TENANT_ID,
+    "queries": [BASIC_QUERY, ADVANCED_QUERY]
+})
+
+def resolve_base_url(url):
+    """Resolve a plain-HTTP host to IPv4 once, so new pool connections skip getaddrinfo
+
+    Returns the base URL to connect to and the Host header to send. Only IPv4 is pinned,
+    since the service binds IPv4 and localhost often resolves to ::1 first; hosts without
+    an IPv4 address and HTTPS URLs, whose certificates need the hostname, keep their name.
+    """
+    parts = urlsplit(url)
+    if parts.scheme != "http":
+        return url, parts.netloc
+    
+    port = parts.port or 80
+    try:
+        address = socket.gethostbyname(parts.hostname)
+    except socket.gaierror:
+        return url, parts.netloc
+    return f"http://{address}:{port}{parts.path}", parts.netloc
+
+RESOLVED_BASE_URL, API_HOST = resolve_base_url(API_BASE_URL)
+
+def create_client(max_connections=64):
+    """One keep-alive client shared by every test, so calls reuse pooled connections"""
+    return httpx.AsyncClient(
+        base_url=RESOLVED_BASE_URL,
+        headers={"Accept-Encoding": "gzip", "Host": API_HOST},
+        timeout=60.0,
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    )
+
+def format_duration(seconds):
+    """Seconds, or microseconds below a millisecond"""
+    if seconds < 0.001:
+        return f"{seconds * 1e6:.1f}µs"
+    return f"{seconds:.3f}s"
+
+async def post_json(client, path, body, params=None):
+    """POST an already serialized JSON body"""
+    return await client.post(path, content=body, headers=JSON_HEADERS, params=params)
+
+async def test_basic_query(client):
+    """Test the /query endpoint with a basic query"""
     
     # Send request
-    start_time = time.time()
-    response = requests.post(f"{API_BASE_URL}/query", json=payload)
-    end_time = time.time()
+    start_time = time.perf_counter()
+    response = await post_json(client, "/query", BASIC_QUERY_BODY, TENANT_PARAMS)
+    end_time = time.perf_counter()
     
     # Print results
     print(f"Status Code: {response.status_code}")
     if response.status_code == 200:
-        result = response.json()
-        print(f"Query: {result['query']}")
-        print(f"Processing Time: {result['processing_time']:.3f}s")
-        print(f"Total Request Time: {end_time - start_time:.3f}s")
-        print(f"LLM Model: {result['llm_model']}")
-        print(f"Response: {result['response'][:300]}...")  # Show truncated response
-        print(f"Sources: {len(result['sources'])}")
+        result = orjson.loads(response.content)
+        lines = [
+            f"Query: {result['query']}",
+            f"Processing Time: {result['processing_time']:.3f}s",
+            f"Total Request Time: {format_duration(end_time - start_time)}",
+            f"LLM Model: {result['llm_model']}",
+            f"Response: {result['response'][:300]}...",  # Show truncated response
+            f"Sources: {len(result['sources'])}"
+        ]
         
         # Show source details
         for i, source in enumerate(result['sources']):
-            print(f"\nSource {i+1}:")
-            print(f"  Score: {source.get('score')}")
-            metadata = source.get('metadata', {})
-            print(f"  Metadata: {', '.join([f'{k}: {v}' for k, v in metadata.items() if k != 'tenant_id'])}")
-            print(f"  Text: {source.get('text', '')[:100]}...")  # Truncate text
+            metadata = source.get('metadata') or {}
+            metadata.pop('tenant_id', None)
+            lines.append(
+                f"\nSource {i+1}:\n"
+                f"  Score: {source.get('score')}\n"
+                f"  Metadata: {', '.join(f'{k}: {v}' for k, v in metadata.items())}\n"
+                f"  Text: {source.get('text', '')[:100]}..."  # Truncate text
+            )
+        
+        # One write for the whole block instead of a print per line
+        sys.stdout.write("\n".join(lines) + "\n")
     else:
         print(f"Error: {response.text}")
+        result = None
     
-    return response.json() if response.status_code == 200 else None
+    return result
 
-def test_advanced_query():
+async def test_advanced_query(client):
     """Test the /query endpoint with advanced options"""
     
-    # Prepare query
-    query = "Explica las ventajas de un sistema multitenancy para implementaciones RAG"
-    
-    # Create request payload with advanced options
-    payload = {
-        "tenant_id": TENANT_ID,
-        "query": query,
-        "collection_name": "default",  # Use your actual collection
-        "llm_model": "gpt-4-turbo",  # Might fail if tenant doesn't have access
-        "similarity_top_k": 6,
-        "response_mode": "refine",  # refine mode for longer, more detailed responses
-        "additional_metadata_filter": {
-            "document_type": "technical"  # Filter by document type if applicable
-        }
-    }
-    
     # Send request
-    response = requests.post(f"{API_BASE_URL}/query", json=payload)
+    response = await post_json(client, "/query", ADVANCED_QUERY_BODY, TENANT_PARAMS)
     
     # Print results
     print(f"\nAdvanced Query Test")
     print(f"Status Code: {response.status_code}")
     if response.status_code == 200:
-        result = response.json()
+        result = orjson.loads(response.content)
         print(f"Response Mode: refine")
         print(f"Requested Model: gpt-4-turbo, Actual Model Used: {result['llm_model']}")
         print(f"Number of sources: {len(result['sources'])}")
         print(f"Response Length: {len(result['response'])} characters")
     else:
         print(f"Error: {response.text}")
+        result = None
     
-    return response.json() if response.status_code == 200 else None
+    return result
 
-def test_list_documents():
+async def test_batch_queries(client):
+    """Test the /query/batch endpoint with several queries in one request"""
+    
+    # Send request
+    response = await post_json(client, "/query/batch", BATCH_QUERY_BODY, TENANT_PARAMS)
+    
+    # Print results
+    print(f"\nBatch Query Test")
+    print(f"Status Code: {response.status_code}")
+    if response.status_code == 200:
+        result = orjson.loads(response.content)
+        print(f"Processing Time: {result['processing_time']:.3f}s")
+        for item in result['results']:
+            if item['result'] is None:
+                print(f"  - Error {item['status_code']}: {item['error']}")
+                continue
+            query_result = item['result']
+            print(f"  - {query_result['query']}")
+            print(f"    Model: {query_result['llm_model']}, Sources: {len(query_result['sources'])}, Response Length: {len(query_result['response'])} characters")
+    else:
+        print(f"Error: {response.text}")
+        result = None
+    
+    return result
+
+async def test_list_documents(client):
     """Test the /documents endpoint"""
     
     # Send request
-    response = requests.get(f"{API_BASE_URL}/documents?tenant_id={TENANT_ID}")
\ No newline at end of file
+    response = await client.get("/documents", params=TENANT_PARAMS)
+    
+    # Print results
+    print(f"\nList Documents Test")
+    print(f"Status Code: {response.status_code}")
+    if response.status_code == 200:
+        result = orjson.loads(response.content)
+        print(f"Total documents: {result['total']}")
+        for document in result['documents']:
+            print(f"  - {document.get('document_id')}: {document.get('source')} ({document.get('collection')})")
+    else:
+        print(f"Error: {response.text}")
+
+async def loadgen(concurrency, total):
+    """Send the basic query `total` times with at most `concurrency` in flight and report latency percentiles"""
+    print("=== QUERY SERVICE LOAD TEST ===")
+    print(f"Testing against: {API_BASE_URL}")
+    print(f"Concurrency: {concurrency}, Requests: {total}")
+    print("=" * 40)
+    
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+    
+    async def send(client):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await post_json(client, "/query", BASIC_QUERY_BODY, TENANT_PARAMS)
+                ok = response.status_code == 200
+            except httpx.HTTPError:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+    
+    async with create_client(max_connections=concurrency) as client:
+        start_time = time.perf_counter()
+        await asyncio.gather(*(send(client) for _ in range(total)))
+        elapsed = time.perf_counter() - start_time
+    
+    print(f"Throughput: {total / elapsed:.1f} req/s")
+    print(f"Errors: {errors} ({errors / total:.1%})")
+    if len(latencies) >= 2:
+        percentiles = statistics.quantiles(latencies, n=100)
+        print(f"Latency p50: {percentiles[49] * 1000:.1f}ms, p95: {percentiles[94] * 1000:.1f}ms, p99: {percentiles[98] * 1000:.1f}ms")
+
+async def run_all_tests(single=False):
+    """Run all tests concurrently; they are independent, so wall time is the slowest one
+
+    The basic and advanced queries go out as one /query/batch call, or as separate
+    /query calls when `single` is set.
+    """
+    print("=== QUERY SERVICE TEST CLIENT ===")
+    print(f"Testing against: {API_BASE_URL}")
+    print(f"Using tenant ID: {TENANT_ID}")
+    print("=" * 40)
+    
+    async with create_client() as client:
+        if single:
+            query_tests = [test_basic_query(client), test_advanced_query(client)]
+        else:
+            query_tests = [test_batch_queries(client)]
+        await asyncio.gather(*query_tests, test_list_documents(client))
+    
+    print("\nAll tests completed!")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query service test client")
+    parser.add_argument("--load", action="store_true", help="run the load generator instead of the tests")
+    parser.add_argument("--single", action="store_true", help="send the test queries to /query one by one instead of as a batch")
+    parser.add_argument("--concurrency", type=int, default=32, help="requests in flight during a load run")
+    parser.add_argument("--total", type=int, default=1000, help="requests to send during a load run")
+    args = parser.parse_args()
+    
+    if args.load:
+        asyncio.run(loadgen(args.concurrency, args.total))
+    else:
+        asyncio.run(run_all_tests(single=args.single))